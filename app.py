@@ -1,19 +1,83 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, session, flash, jsonify, g, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import json
 from datetime import datetime, timedelta
 import uuid
-from sqlalchemy import inspect, text
+import random
+import base64
+import struct
+import heapq
+import mmap
+import zlib
+from collections import OrderedDict, namedtuple
+from sqlalchemy import inspect, text, event, select, insert, update, func, and_, or_, case, union_all
+from sqlalchemy.orm import aliased
 import threading
 import time
+import functools
+import click
+import math
+import re
+import gzip
+import hashlib
+import mimetypes
+import itertools
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24).hex()
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+try:
+    import brotli
+except ImportError:  # Optional: static assets are then pre-compressed with gzip only
+    brotli = None
+
+db = SQLAlchemy()
+bp = Blueprint('chess', __name__, cli_group=None)
+
+def create_app(config=None):
+    """Create and configure the application; the schema is upgraded separately with `flask upgrade-db`"""
+    app = Flask(__name__, instance_relative_config=True)
+    app.config.from_mapping(
+        # Must be shared by every worker process; the random fallback only suits a single dev server
+        SECRET_KEY=os.environ.get('SECRET_KEY') or os.urandom(24).hex(),
+        SQLALCHEMY_DATABASE_URI='sqlite:///users.db',
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        ARCHIVE_DIR=os.path.join(app.instance_path, 'archive'),
+        ARCHIVE_AFTER_DAYS=30,
+        ARCHIVE_SEGMENT_BYTES=64 * 1024 * 1024,
+        SPECTATOR_REFRESH_SECONDS=1.0,
+        ENGINE_WORKERS=max(1, (os.cpu_count() or 2) // 2),
+        ENGINE_DEFAULT_LEVEL=3,
+        ANALYSIS_WORKERS=os.cpu_count() or 1,
+        ANALYSIS_DEPTH=2,
+        ANALYSIS_MOVETIME_MS=500,
+        ANALYSIS_QUEUE_SIZE=256,
+        ANALYSIS_BATCH_SIZE=20,
+        ANALYSIS_FLUSH_SECONDS=5.0,
+        POLL_MIN_MS=500,
+        POLL_MAX_MS=10000,
+        POLL_OWN_TURN_MS=2000,  # kept short so the opponent's reply to our move shows up quickly
+        POLL_TARGET_RATE=200,  # polls/s per process before clients are asked to slow down
+        POLL_BUCKET_RATE=2.0,  # sustained polls/s allowed per session
+        POLL_BUCKET_BURST=10,
+        CLOCK_BASE_SECONDS=300,
+        CLOCK_INCREMENT_SECONDS=5,
+        FLAG_CHECK_SECONDS=5.0,  # longest the flag-fall scheduler sleeps between deadline lookups
+        QUEUE_HEARTBEAT_SECONDS=10,  # a waiting player's heartbeat is written at most this often
+        QUEUE_TTL_SECONDS=30,  # queue entries without a heartbeat for this long are never matched
+        QUEUE_SWEEP_SECONDS=15,
+    )
+    app.config.from_pyfile('config.py', silent=True)
+    if config:
+        app.config.update(config)
+    
+    db.init_app(app)
+    app.register_blueprint(bp)
+    return app
 
 # User model
 class User(db.Model):
@@ -25,6 +89,7 @@ class User(db.Model):
     games_lost = db.Column(db.Integer, default=0)
     games_drawn = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    is_engine = db.Column(db.Boolean, nullable=False, default=False)
 
     def __repr__(self):
         return f'<User {self.name}>'
@@ -37,7 +102,7 @@ class User(db.Model):
         
     def update_stats(self, game_result):
         """Update user statistics based on game result
-        game_result can be 'win', 'loss', or 'draw'
+        game_result can be 'win', 'loss', or 'draw'; the caller commits
         """
         self.games_played += 1
         if game_result == 'win':
@@ -46,7 +111,6 @@ class User(db.Model):
             self.games_lost += 1
         elif game_result == 'draw':
             self.games_drawn += 1
-        db.session.commit()
 
 def initial_board_state():
     """Create the initial chess board state"""
@@ -62,12 +126,75 @@ def initial_board_state():
         "e1": "white_king", "f1": "white_bishop", "g1": "white_knight", "h1": "white_rook"
     }
 
+# Position tracking for draw detection
+PIECE_NAMES = [f"{color}_{piece_type}" for color in ('white', 'black')
+               for piece_type in ('pawn', 'knight', 'bishop', 'rook', 'queen', 'king')]
+SIGNATURE_LETTERS = {'pawn': 'P', 'knight': 'N', 'bishop': 'B', 'rook': 'R', 'queen': 'Q'}
+
+# Fixed seed so hashes are identical across worker processes and restarts
+_zobrist_random = random.Random(0x0C4E55)
+ZOBRIST_PIECES = {(piece, col + str(row)): _zobrist_random.getrandbits(64)
+                  for piece in PIECE_NAMES for col in "abcdefgh" for row in range(1, 9)}
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+
+def position_hash(board, turn):
+    """Compute the Zobrist hash of a position from scratch"""
+    value = ZOBRIST_BLACK_TO_MOVE if turn == 'black' else 0
+    for pos, piece in board.items():
+        value ^= ZOBRIST_PIECES[(piece, pos)]
+    return value
+
+def update_position_hash(value, piece, from_pos, to_pos, captured=None):
+    """Incrementally update a Zobrist hash for one move (also flips the side to move)"""
+    value ^= ZOBRIST_PIECES[(piece, from_pos)] ^ ZOBRIST_PIECES[(piece, to_pos)] ^ ZOBRIST_BLACK_TO_MOVE
+    if captured:
+        value ^= ZOBRIST_PIECES[(captured, to_pos)]
+    return value
+
+def material_signature(board):
+    """Describe the material on the board, e.g. 'QRBNPP/qrbnpp' (kings omitted)"""
+    sides = {'white': [], 'black': []}
+    for piece in board.values():
+        color, piece_type = piece.split('_')
+        if piece_type != 'king':
+            sides[color].append(SIGNATURE_LETTERS[piece_type])
+    order = 'QRBNP'
+    white = ''.join(sorted(sides['white'], key=order.index))
+    black = ''.join(sorted(sides['black'], key=order.index)).lower()
+    return f"{white}/{black}"
+
+def remove_from_signature(signature, piece):
+    """Drop one captured piece from a material signature"""
+    color, piece_type = piece.split('_')
+    white, black = signature.split('/')
+    letter = SIGNATURE_LETTERS[piece_type]
+    if color == 'white':
+        white = white.replace(letter, '', 1)
+    else:
+        black = black.replace(letter.lower(), '', 1)
+    return f"{white}/{black}"
+
+def is_insufficient_material(signature, board):
+    """Check whether neither side can possibly deliver mate"""
+    minors = signature.replace('/', '').upper()
+    if any(letter in minors for letter in 'PRQ'):
+        return False
+    # K vs K, K+minor vs K
+    if len(minors) <= 1:
+        return True
+    # Only bishops, all on the same square color
+    if set(minors) == {'B'}:
+        square_colors = {(ord(pos[0]) + int(pos[1])) % 2
+                         for pos, piece in board.items() if piece.endswith('_bishop')}
+        return len(square_colors) == 1
+    return False
+
 # Game model
 class Game(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     white_player_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     black_player_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    board_state = db.Column(db.Text, nullable=False, default=json.dumps(initial_board_state()))
+    board_state = db.Column(db.Text, nullable=False, default=lambda: json.dumps(initial_board_state()))
     current_turn = db.Column(db.String(5), nullable=False, default='white')
     is_finished = db.Column(db.Boolean, default=False)
     winner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
@@ -75,70 +202,149 @@ class Game(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     last_activity = db.Column(db.DateTime, default=datetime.utcnow)
     timeout_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=1)  # bumped on every state change, see __mapper_args__
+    position_hash = db.Column(db.String(16), nullable=True)  # Zobrist hash of the current position
+    position_counts = db.Column(db.Text, nullable=True)  # hash -> occurrences since the last capture or pawn move
+    halfmove_clock = db.Column(db.Integer, nullable=False, default=0)
+    material = db.Column(db.String(40), nullable=True)  # material signature, see material_signature()
+    engine_depth = db.Column(db.Integer, nullable=True)  # search limits when playing the computer
+    engine_movetime_ms = db.Column(db.Integer, nullable=True)
+    engine_search = db.Column(db.Text, nullable=True)  # JSON statistics of the engine's last search
+    # Per-player clocks: remaining time as of the start of the current turn.
+    # The running clock is derived on read from turn_started_at, never written by polls.
+    clock_base_ms = db.Column(db.Integer, nullable=True)  # NULL for untimed (imported) games
+    clock_increment_ms = db.Column(db.Integer, nullable=True)
+    white_clock_ms = db.Column(db.Integer, nullable=True)
+    black_clock_ms = db.Column(db.Integer, nullable=True)
+    turn_started_at = db.Column(db.DateTime, nullable=True)
+    # When the side to move runs out of time, kept so the scheduler can find it by index
+    flag_deadline = db.Column(db.DateTime, nullable=True, index=True)
     
     white_player = db.relationship('User', foreign_keys=[white_player_id])
     black_player = db.relationship('User', foreign_keys=[black_player_id])
     winner = db.relationship('User', foreign_keys=[winner_id])
     timeout_user = db.relationship('User', foreign_keys=[timeout_user_id])
     
-    def update_activity(self):
-        """Update the last activity timestamp"""
-        self.last_activity = datetime.utcnow()
-        db.session.commit()
+    # Every UPDATE is a compare-and-swap: `... WHERE id = ? AND version = ?` with the
+    # version loaded by this session, bumping it by one. If another request or
+    # worker changed the game first no row matches and StaleDataError is raised.
+    __mapper_args__ = {'version_id_col': version}
+    
+    # One covering index per player column: serves history pages (keyset on updated_at, id)
+    # and the per-player result aggregation in rebuild-stats without touching the table
+    __table_args__ = (
+        db.Index('ix_game_white_history', 'white_player_id', 'is_finished', 'updated_at', 'id',
+                 'black_player_id', 'winner_id', 'timeout_user_id'),
+        db.Index('ix_game_black_history', 'black_player_id', 'is_finished', 'updated_at', 'id',
+                 'white_player_id', 'winner_id', 'timeout_user_id'),
+    )
     
-    def check_timeout(self):
-        """Check if the current player's turn has timed out (1 minute)"""
-        if self.is_finished:
-            return False
-            
-        # If last_activity is None, update it and return
-        if self.last_activity is None:
-            print(f"Game {self.id}: last_activity was None, updating with current time")
-            self.last_activity = datetime.utcnow()
-            db.session.commit()
-            return False
-            
-        # Calculate time since last activity
-        current_time = datetime.utcnow()
-        time_since_last_activity = current_time - self.last_activity
-        seconds_inactive = time_since_last_activity.total_seconds()
+    def track_position(self, piece, from_pos, to_pos, captured, board):
+        """Update draw tracking for a move already applied to board; returns the draw reason or None"""
+        if self.position_hash is None:
+            # First tracked move of this game: derive the state from the board before the move
+            board_before = board.copy()
+            board_before[from_pos] = piece
+            if captured:
+                board_before[to_pos] = captured
+            else:
+                del board_before[to_pos]
+            self.position_hash = format(position_hash(board_before, self.current_turn), '016x')
+            self.position_counts = json.dumps({self.position_hash: 1})
+            self.halfmove_clock = 0
+            self.material = material_signature(board_before)
         
-        print(f"Game {self.id}: {seconds_inactive:.1f} seconds since last activity. Current turn: {self.current_turn}")
+        new_hash = format(update_position_hash(int(self.position_hash, 16), piece, from_pos, to_pos, captured), '016x')
+        if captured or piece.endswith('_pawn'):
+            self.halfmove_clock = 0
+            counts = {}
+        else:
+            self.halfmove_clock = (self.halfmove_clock or 0) + 1
+            counts = json.loads(self.position_counts or '{}')
+        counts[new_hash] = counts.get(new_hash, 0) + 1
+        self.position_hash = new_hash
+        self.position_counts = json.dumps(counts)
+        if captured:
+            self.material = remove_from_signature(self.material, captured)
         
-        # If more than 1 minute has passed, the player has timed out
-        if seconds_inactive > 60:
-            print(f"Game {self.id}: TIMEOUT detected after {seconds_inactive:.1f} seconds of inactivity")
-            # Determine the winner (opponent of the current player)
-            if self.current_turn == 'white':
-                self.winner_id = self.black_player_id
-                self.timeout_user_id = self.white_player_id
-                winner = User.query.get(self.black_player_id)
-                loser = User.query.get(self.white_player_id)
-            else:
-                self.winner_id = self.white_player_id
-                self.timeout_user_id = self.black_player_id
-                winner = User.query.get(self.white_player_id)
-                loser = User.query.get(self.black_player_id)
-                
-            print(f"Game {self.id}: {winner.name} wins due to {loser.name}'s inactivity")
-            self.is_finished = True
-            db.session.commit()
-            return True
-            
-        return False
+        if counts[new_hash] >= 3:
+            return 'threefold_repetition'
+        if self.halfmove_clock >= 100:
+            return 'fifty_move_rule'
+        if captured and is_insufficient_material(self.material, board):
+            return 'insufficient_material'
+        return None
+    
+    def start_clock(self, base_seconds, increment_seconds, now=None):
+        """Give both players base_seconds and start white's clock"""
+        now = now or datetime.utcnow()
+        self.clock_base_ms = self.white_clock_ms = self.black_clock_ms = int(base_seconds * 1000)
+        self.clock_increment_ms = int(increment_seconds * 1000)
+        self.turn_started_at = now
+        self.flag_deadline = now + timedelta(milliseconds=self.clock_base_ms)
+    
+    def clock_ms(self, color, now=None):
+        """Remaining time of color in milliseconds, computed without writing anything"""
+        stored = self.white_clock_ms if color == 'white' else self.black_clock_ms
+        if stored is None or self.is_finished or color != self.current_turn or self.turn_started_at is None:
+            return stored
+        elapsed = (now or datetime.utcnow()) - self.turn_started_at
+        return max(0, stored - int(elapsed.total_seconds() * 1000))
+    
+    def has_flagged(self, now=None):
+        """Check whether the side to move has run out of time"""
+        remaining = self.clock_ms(self.current_turn, now)
+        return remaining is not None and remaining <= 0 and not self.is_finished
+    
+    def stop_clock(self, now=None):
+        """Freeze the running clock at its current value, e.g. when the game ends"""
+        if self.flag_deadline is None or self.white_clock_ms is None:
+            return
+        remaining = max(0, int((self.flag_deadline - (now or datetime.utcnow())).total_seconds() * 1000))
+        if self.current_turn == 'white':
+            self.white_clock_ms = remaining
+        else:
+            self.black_clock_ms = remaining
+        self.flag_deadline = None
+    
+    def press_clock(self, now):
+        """Stop the mover's clock, add the increment and start the opponent's; call before switching current_turn"""
+        if self.white_clock_ms is None:
+            return
+        mover = self.current_turn
+        remaining = self.clock_ms(mover, now) + (self.clock_increment_ms or 0)
+        if mover == 'white':
+            self.white_clock_ms = remaining
+            opponent_remaining = self.black_clock_ms
+        else:
+            self.black_clock_ms = remaining
+            opponent_remaining = self.white_clock_ms
+        self.turn_started_at = now
+        self.flag_deadline = now + timedelta(milliseconds=opponent_remaining)
 
 # Queue model to store players waiting for a game
 class Queue(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=False)
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # refreshed by the waiting page's polls
     
     user = db.relationship('User')
 
-# Move model to store game moves
+# Premove registered by the player waiting for the opponent; played as the reply to the next move.
+# Kept out of the game row so registering one does not bump the game version.
+class Premove(db.Model):
+    game_id = db.Column(db.String(36), db.ForeignKey('game.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    ply = db.Column(db.Integer, nullable=False)  # plies played at registration; only valid as the reply to the next one
+    from_position = db.Column(db.String(2), nullable=False)
+    to_position = db.Column(db.String(2), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Move model to store game moves (legacy one-row-per-ply format, superseded by MoveList)
 class Move(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    game_id = db.Column(db.String(36), db.ForeignKey('game.id'), nullable=False)
+    game_id = db.Column(db.String(36), db.ForeignKey('game.id'), nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     from_position = db.Column(db.String(2), nullable=False)
     to_position = db.Column(db.String(2), nullable=False)
@@ -148,126 +354,664 @@ class Move(db.Model):
     game = db.relationship('Game')
     user = db.relationship('User')
 
-with app.app_context():
-    db.create_all()
-    
-    # Check and update database schema if needed
-    inspector = inspect(db.engine)
-    if 'game' in inspector.get_table_names():
-        columns = [col['name'] for col in inspector.get_columns('game')]
-        
-        # Add last_activity column if it doesn't exist
-        if 'last_activity' not in columns:
-            # Add last_activity column without a default value
-            db.session.execute(text("ALTER TABLE game ADD COLUMN last_activity DATETIME"))
-            db.session.commit()
-            print("Added last_activity column to game table")
-            
-            # Now update all records with the current timestamp
-            current_time = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-            db.session.execute(text(f"UPDATE game SET last_activity = '{current_time}'"))
-            db.session.commit()
-            print("Updated all games with current timestamp")
-        
-        # Add timeout_user_id column if it doesn't exist
-        if 'timeout_user_id' not in columns:
-            db.session.execute(text("ALTER TABLE game ADD COLUMN timeout_user_id INTEGER"))
-            db.session.commit()
-            print("Added timeout_user_id column to game table")
-    
-    # Check and update user table for statistics columns
-    if 'user' in inspector.get_table_names():
-        user_columns = [col['name'] for col in inspector.get_columns('user')]
-        
-        # Add games_played column if it doesn't exist
-        if 'games_played' not in user_columns:
-            db.session.execute(text("ALTER TABLE user ADD COLUMN games_played INTEGER DEFAULT 0"))
-            db.session.commit()
-            print("Added games_played column to user table")
-        
-        # Add games_won column if it doesn't exist
-        if 'games_won' not in user_columns:
-            db.session.execute(text("ALTER TABLE user ADD COLUMN games_won INTEGER DEFAULT 0"))
-            db.session.commit()
-            print("Added games_won column to user table")
+# Packed move encoding helpers
+FILES = "abcdefgh"
+
+def square_index(pos):
+    """Map a square name like 'e4' to 0-63 (a1 = 0, h8 = 63)"""
+    return (int(pos[1]) - 1) * 8 + FILES.index(pos[0])
+
+def square_name(index):
+    """Map a 0-63 square index back to its name"""
+    return FILES[index % 8] + str(index // 8 + 1)
+
+def encode_move(from_pos, to_pos):
+    """Pack a move into 16 bits: bits 0-5 from square, 6-11 to square, 12-15 reserved flags"""
+    return square_index(from_pos) | (square_index(to_pos) << 6)
+
+def decode_move(code):
+    """Unpack a 16-bit move into (from_pos, to_pos)"""
+    return square_name(code & 0x3F), square_name((code >> 6) & 0x3F)
+
+def encode_varint(value):
+    """Encode a non-negative integer as an unsigned LEB128 varint"""
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def iter_varints(data):
+    """Yield the integers from a buffer of concatenated LEB128 varints"""
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield value
+            value = shift = 0
+
+# Checkpoints: the position after every CHECKPOINT_INTERVAL plies, 4 bits per square
+CHECKPOINT_INTERVAL = 16
+POSITION_BYTES = 32
+PIECE_NIBBLES = {f"{color}_{piece}": base + offset
+                 for color, base in (('white', 0), ('black', 8))
+                 for offset, piece in enumerate(('pawn', 'knight', 'bishop', 'rook', 'queen', 'king'), 1)}
+NIBBLE_PIECES = {nibble: piece for piece, nibble in PIECE_NIBBLES.items()}
+
+def pack_position(board):
+    """Pack a board into 32 bytes, one nibble per square from a1 to h8 (0 = empty)"""
+    nibbles = bytearray(64)
+    for pos, piece in board.items():
+        nibbles[square_index(pos)] = PIECE_NIBBLES[piece]
+    return bytes(nibbles[i] | (nibbles[i + 1] << 4) for i in range(0, 64, 2))
+
+def unpack_position(data):
+    """Inverse of pack_position"""
+    board = {}
+    for i, byte in enumerate(data):
+        if byte & 0x0F:
+            board[square_name(2 * i)] = NIBBLE_PIECES[byte & 0x0F]
+        if byte >> 4:
+            board[square_name(2 * i + 1)] = NIBBLE_PIECES[byte >> 4]
+    return board
+
+def replay_packed_moves(board, moves, start, end):
+    """Apply plies start..end-1 of a packed move buffer to board in place"""
+    for (code,) in struct.iter_unpack('<H', moves[2 * start:2 * end]):
+        from_pos, to_pos = decode_move(code)
+        board[to_pos] = board.pop(from_pos, None)
+    return board
+
+def build_checkpoints(moves):
+    """Checkpoint buffer for a whole packed move buffer"""
+    board = initial_board_state()
+    checkpoints = bytearray()
+    for ply in range(CHECKPOINT_INTERVAL, len(moves) // 2 + 1, CHECKPOINT_INTERVAL):
+        replay_packed_moves(board, moves, ply - CHECKPOINT_INTERVAL, ply)
+        checkpoints += pack_position(board)
+    return bytes(checkpoints)
+
+# A decoded entry of a MoveList
+PackedMove = namedtuple('PackedMove', ['ply', 'from_pos', 'to_pos', 'played_at'])
+
+# Packed move list: one row per game holding its whole history
+class MoveList(db.Model):
+    game_id = db.Column(db.String(36), db.ForeignKey('game.id'), primary_key=True)
+    moves = db.Column(db.LargeBinary, nullable=False, default=b'')  # little-endian 16-bit moves
+    timings = db.Column(db.LargeBinary, nullable=False, default=b'')  # varint ms since previous move
+    ply_count = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_move_at = db.Column(db.DateTime, nullable=True)
+    checkpoints = db.Column(db.LargeBinary, nullable=False, default=b'')  # packed positions, see build_checkpoints
+    
+    def append(self, from_pos, to_pos, played_at=None):
+        """Append one ply to the end of the list"""
+        played_at = played_at or datetime.utcnow()
+        previous = self.last_move_at or self.started_at or played_at
+        delta_ms = max(0, int((played_at - previous).total_seconds() * 1000))
         
-        # Add games_lost column if it doesn't exist
-        if 'games_lost' not in user_columns:
-            db.session.execute(text("ALTER TABLE user ADD COLUMN games_lost INTEGER DEFAULT 0"))
-            db.session.commit()
-            print("Added games_lost column to user table")
+        self.moves = (self.moves or b'') + struct.pack('<H', encode_move(from_pos, to_pos))
+        self.timings = (self.timings or b'') + encode_varint(delta_ms)
+        self.ply_count = (self.ply_count or 0) + 1
+        self.last_move_at = played_at
         
-        # Add games_drawn column if it doesn't exist
-        if 'games_drawn' not in user_columns:
-            db.session.execute(text("ALTER TABLE user ADD COLUMN games_drawn INTEGER DEFAULT 0"))
-            db.session.commit()
-            print("Added games_drawn column to user table")
+        # Only extend a complete checkpoint sequence, so checkpoint i always follows ply (i + 1) * K
+        checkpoints = self.checkpoints or b''
+        if (self.ply_count % CHECKPOINT_INTERVAL == 0
+                and len(checkpoints) == (self.ply_count // CHECKPOINT_INTERVAL - 1) * POSITION_BYTES):
+            self.checkpoints = checkpoints + pack_position(self.position_at(self.ply_count))
+    
+    def position_at(self, ply, start=None):
+        """Board after `ply` plies, replayed from the nearest checkpoint or from a closer known (ply, board)"""
+        index = min(ply // CHECKPOINT_INTERVAL, len(self.checkpoints or b'') // POSITION_BYTES)
+        from_ply = index * CHECKPOINT_INTERVAL
+        if start is not None and from_ply < start[0] <= ply:
+            from_ply, board = start[0], dict(start[1])
+        elif index:
+            board = unpack_position(self.checkpoints[(index - 1) * POSITION_BYTES:index * POSITION_BYTES])
+        else:
+            board = initial_board_state()
+        return replay_packed_moves(board, self.moves or b'', from_ply, ply)
+    
+    def iter_moves(self):
+        """Lazily decode the moves in ply order"""
+        played_at = self.started_at
+        codes = struct.iter_unpack('<H', self.moves or b'')
+        for ply, ((code,), delta_ms) in enumerate(zip(codes, iter_varints(self.timings or b''))):
+            played_at = played_at + timedelta(milliseconds=delta_ms)
+            from_pos, to_pos = decode_move(code)
+            yield PackedMove(ply, from_pos, to_pos, played_at)
+
+def build_move_list(game_id, started_at):
+    """Build an unsaved MoveList from a game's legacy Move rows"""
+    move_list = MoveList(game_id=game_id, moves=b'', timings=b'', ply_count=0, started_at=started_at, checkpoints=b'')
+    legacy_moves = (db.session.query(Move.from_position, Move.to_position, Move.created_at)
+                    .filter(Move.game_id == game_id)
+                    .order_by(Move.created_at, Move.id))
+    for from_pos, to_pos, created_at in legacy_moves:
+        move_list.append(from_pos, to_pos, created_at)
+    return move_list
+
+def count_plies(game_id):
+    """Number of plies played, read without migrating legacy Move rows"""
+    ply_count = db.session.query(MoveList.ply_count).filter(MoveList.game_id == game_id).scalar()
+    if ply_count is None:
+        ply_count = db.session.query(func.count(Move.id)).filter(Move.game_id == game_id).scalar()
+    return ply_count
+
+def get_move_list(game):
+    """Return the game's MoveList, migrating legacy Move rows on first access"""
+    move_list = MoveList.query.get(game.id)
+    if move_list is None:
+        move_list = build_move_list(game.id, game.created_at or datetime.utcnow())
+        db.session.add(move_list)
+    return move_list
+
+# Index of finished games moved to the cold archive
+class ArchivedGame(db.Model):
+    game_id = db.Column(db.String(36), primary_key=True)
+    white_player_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    black_player_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    winner_id = db.Column(db.Integer, nullable=True)
+    timeout_user_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=False)
+    segment = db.Column(db.Integer, nullable=False)
+    offset = db.Column(db.Integer, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_archived_game_white_history', 'white_player_id', 'finished_at', 'game_id',
+                 'black_player_id', 'winner_id', 'timeout_user_id'),
+        db.Index('ix_archived_game_black_history', 'black_player_id', 'finished_at', 'game_id',
+                 'white_player_id', 'winner_id', 'timeout_user_id'),
+        db.Index('ix_archived_game_created', 'created_at', 'game_id'),
+    )
+
+# Post-game analysis results, one row per finished game
+class GameAnalysis(db.Model):
+    game_id = db.Column(db.String(36), primary_key=True)
+    status = db.Column(db.String(10), nullable=False, default='pending', index=True)  # pending, done, failed
+    white_accuracy = db.Column(db.Float, nullable=True)
+    black_accuracy = db.Column(db.Float, nullable=True)
+    annotations = db.Column(db.Text, nullable=True)  # JSON list, one entry per ply
+    positions = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    analyzed_at = db.Column(db.DateTime, nullable=True)
+
+# Identity helpers
+def get_current_user():
+    """Return the logged-in User, loading it at most once per request"""
+    if 'user_id' not in session:
+        return None
+    if 'current_user' not in g:
+        g.current_user = User.query.get(session['user_id'])
+    return g.current_user
+
+class LRUCache:
+    """Thread-safe mapping that keeps only the `maxsize` most recently used entries"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class UserNameCache:
+    """Small TTL/LRU cache mapping user id -> display name"""
+    def __init__(self, maxsize=1024, ttl=300):
+        self.ttl = ttl
+        self._entries = LRUCache(maxsize)
+
+    def get(self, user_id):
+        """Return the name for user_id, querying the database on a miss"""
+        if user_id is None:
+            return None
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] > now:
+            return entry[0]
         
-        # Add created_at column if it doesn't exist
-        if 'created_at' not in user_columns:
-            db.session.execute(text("ALTER TABLE user ADD COLUMN created_at DATETIME"))
-            db.session.commit()
-            
-            # Now update all records with the current timestamp
-            current_time = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-            db.session.execute(text(f"UPDATE user SET created_at = '{current_time}'"))
-            db.session.commit()
-            print("Added created_at column to user table")
+        name = db.session.query(User.name).filter(User.id == user_id).scalar()
+        if name is None:
+            return None
+        self._entries.put(user_id, (name, now + self.ttl))
+        return name
+
+    def invalidate(self, user_id):
+        """Drop the cached name for user_id"""
+        self._entries.pop(user_id)
+
+    def clear(self):
+        self._entries.clear()
+
+user_names = UserNameCache()
+
+def display_name(user_id):
+    """Return the display name for a user id (cached)"""
+    return user_names.get(user_id)
 
-# Add a background task to check for timeouts
-def check_for_timeouts():
-    """Background task to periodically check for game timeouts"""
-    print("Starting timeout checker background task...")
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_user_name(mapper, connection, target):
+    user_names.invalidate(target.id)
+
+# Static assets and response compression
+ASSET_CACHE_SECONDS = 365 * 24 * 3600
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json'}
+COMPRESS_MIN_BYTES = 500
+
+# A content-hashed file from static/ with its pre-compressed variants
+StaticAsset = namedtuple('StaticAsset', ['hashed_name', 'mimetype', 'data', 'gzipped', 'brotli_data'])
+
+class AssetManifest:
+    """Content-hashed, pre-compressed copies of the files under static/, built on first use"""
+    def __init__(self):
+        self._by_path = None
+        self._by_hashed_name = None
+        self._built_signature = None
+        self._lock = threading.Lock()
+    
+    def _files(self, folder):
+        for root, _, files in os.walk(folder):
+            for filename in files:
+                if not filename.startswith('.'):
+                    full_path = os.path.join(root, filename)
+                    yield os.path.relpath(full_path, folder).replace(os.sep, '/'), full_path
+    
+    def _signature(self, folder):
+        """Modification time of every file, to notice edits without re-reading them"""
+        return sorted((path, os.stat(full_path).st_mtime_ns) for path, full_path in self._files(folder))
+    
+    def _build(self, folder):
+        by_path, by_hashed_name = {}, {}
+        for path, full_path in self._files(folder):
+            with open(full_path, 'rb') as f:
+                data = f.read()
+            stem, extension = os.path.splitext(path)
+            asset = StaticAsset(f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}",
+                                mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                                data,
+                                gzip.compress(data, compresslevel=9, mtime=0),
+                                brotli.compress(data) if brotli else None)
+            by_path[path] = by_hashed_name[asset.hashed_name] = asset
+        return by_path, by_hashed_name
+    
+    def _tables(self):
+        folder = current_app.static_folder
+        # In debug mode edited files show up on the next request, but are only re-read once they change
+        signature = self._signature(folder) if current_app.debug else None
+        with self._lock:
+            if self._by_path is None or signature != self._built_signature:
+                self._by_path, self._by_hashed_name = self._build(folder)
+                self._built_signature = signature
+            return self._by_path, self._by_hashed_name
+    
+    def hashed_name(self, path):
+        """Versioned file name for a path relative to static/"""
+        return self._tables()[0][path].hashed_name
+    
+    def get(self, hashed_name):
+        return self._tables()[1].get(hashed_name)
+
+assets = AssetManifest()
+
+@bp.app_template_global()
+def asset_url(path):
+    """URL of a static file that changes whenever the file does"""
+    return url_for('chess.static_asset', filename=assets.hashed_name(path))
+
+@bp.route('/assets/<path:filename>')
+def static_asset(filename):
+    """Serve a content-hashed static file, pre-compressed, with far-future caching"""
+    asset = assets.get(filename)
+    if asset is None:
+        return jsonify({"error": "Asset not found"}), 404
+    
+    if asset.brotli_data is not None and 'br' in request.accept_encodings:
+        body, encoding = asset.brotli_data, 'br'
+    elif 'gzip' in request.accept_encodings:
+        body, encoding = asset.gzipped, 'gzip'
+    else:
+        body, encoding = asset.data, None
+    
+    response = Response(body, mimetype=asset.mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_CACHE_SECONDS
+    response.cache_control.immutable = True
+    response.set_etag(f"{asset.hashed_name}-{encoding or 'identity'}")
+    return response.make_conditional(request)
+
+@bp.after_app_request
+def compress_response(response):
+    """Gzip HTML and JSON responses for clients that accept it"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'gzip' not in request.accept_encodings):
+        return response
+    
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    # The compressed body is a different representation of the same resource
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Schema migrations
+# Applied once, out of band, with `flask upgrade-db`; never at import or request time.
+# The schema_version table holds the number of the last migration applied.
+def add_missing_columns(connection, table, columns):
+    """Add the columns an older database lacks; columns is a list of (name, DDL type)"""
+    inspector = inspect(connection)
+    if table not in inspector.get_table_names():
+        return
+    existing = {column['name'] for column in inspector.get_columns(table)}
+    for name, ddl in columns:
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+            print(f"Added {name} column to {table} table")
+
+def migrate_unversioned_schema(connection):
+    """Bring a database created before schema versioning up to date"""
+    inspector = inspect(connection)
+    game_columns = {column['name'] for column in inspector.get_columns('game')} if inspector.has_table('game') else set()
+    user_columns = {column['name'] for column in inspector.get_columns('user')} if inspector.has_table('user') else set()
+    
+    # Tables added since the database was created
+    db.metadata.create_all(connection)
+    
+    now = datetime.utcnow()
+    add_missing_columns(connection, 'game', [
+        ('last_activity', 'DATETIME'),
+        ('timeout_user_id', 'INTEGER'),
+        ('version', 'INTEGER NOT NULL DEFAULT 1'),
+        ('position_hash', 'VARCHAR(16)'),
+        ('position_counts', 'TEXT'),
+        ('halfmove_clock', 'INTEGER NOT NULL DEFAULT 0'),
+        ('material', 'VARCHAR(40)'),
+        ('engine_depth', 'INTEGER'),
+        ('engine_movetime_ms', 'INTEGER'),
+    ])
+    if game_columns and 'last_activity' not in game_columns:
+        connection.execute(text("UPDATE game SET last_activity = :now"), {"now": now})
+    
+    add_missing_columns(connection, 'user', [
+        ('games_played', 'INTEGER DEFAULT 0'),
+        ('games_won', 'INTEGER DEFAULT 0'),
+        ('games_lost', 'INTEGER DEFAULT 0'),
+        ('games_drawn', 'INTEGER DEFAULT 0'),
+        ('created_at', 'DATETIME'),
+        ('is_engine', 'BOOLEAN NOT NULL DEFAULT 0'),
+    ])
+    if user_columns and 'created_at' not in user_columns:
+        connection.execute(text("UPDATE user SET created_at = :now"), {"now": now})
+    
+    # Index legacy move rows by game so history lookups stop scanning the table
+    if 'ix_move_game_id' not in {index['name'] for index in inspect(connection).get_indexes('move')}:
+        connection.execute(text("CREATE INDEX ix_move_game_id ON move (game_id)"))
+        print("Added game_id index to move table")
+
+def add_player_clocks(connection):
+    """Add per-player clocks and start them for games in progress"""
+    add_missing_columns(connection, 'game', [
+        ('clock_base_ms', 'INTEGER'),
+        ('clock_increment_ms', 'INTEGER'),
+        ('white_clock_ms', 'INTEGER'),
+        ('black_clock_ms', 'INTEGER'),
+        ('turn_started_at', 'DATETIME'),
+        ('flag_deadline', 'DATETIME'),
+    ])
+    if 'ix_game_flag_deadline' not in {index['name'] for index in inspect(connection).get_indexes('game')}:
+        connection.execute(text("CREATE INDEX ix_game_flag_deadline ON game (flag_deadline)"))
+        print("Added flag_deadline index to game table")
+    
+    base_ms = current_app.config['CLOCK_BASE_SECONDS'] * 1000
+    now = datetime.utcnow()
+    connection.execute(text(
+        "UPDATE game SET clock_base_ms = :base, clock_increment_ms = :increment, white_clock_ms = :base, "
+        "black_clock_ms = :base, turn_started_at = :now, flag_deadline = :deadline "
+        "WHERE is_finished = 0 AND white_clock_ms IS NULL"
+    ), {"base": base_ms, "increment": current_app.config['CLOCK_INCREMENT_SECONDS'] * 1000,
+        "now": now, "deadline": now + timedelta(milliseconds=base_ms)})
+
+def add_player_result_indexes(connection):
+    """Index game results by player for rebuild-stats"""
+    existing = {index['name'] for index in inspect(connection).get_indexes('game')}
+    for name, column in (('ix_game_white_result', 'white_player_id'), ('ix_game_black_result', 'black_player_id')):
+        if name not in existing:
+            connection.execute(text(f"CREATE INDEX {name} ON game ({column}, is_finished, winner_id)"))
+            print(f"Added {name} index to game table")
+
+def add_queue_heartbeat(connection):
+    """Add the queue heartbeat column and its index"""
+    add_missing_columns(connection, 'queue', [('last_seen_at', 'DATETIME')])
+    # Players already waiting get a full TTL to send their first heartbeat
+    connection.execute(text("UPDATE queue SET last_seen_at = :now WHERE last_seen_at IS NULL"),
+                       {"now": datetime.utcnow()})
+    if 'ix_queue_last_seen_at' not in {index['name'] for index in inspect(connection).get_indexes('queue')}:
+        connection.execute(text("CREATE INDEX ix_queue_last_seen_at ON queue (last_seen_at)"))
+        print("Added last_seen_at index to queue table")
+
+def add_move_list_checkpoints(connection):
+    """Add position checkpoints to move lists and build them for existing games"""
+    add_missing_columns(connection, 'move_list', [('checkpoints', "BLOB NOT NULL DEFAULT x''")])
+    after = ''
+    while True:
+        rows = connection.execute(text(
+            "SELECT game_id, moves FROM move_list WHERE ply_count >= :interval AND game_id > :after "
+            "ORDER BY game_id LIMIT 500"
+        ), {"interval": CHECKPOINT_INTERVAL, "after": after}).all()
+        if not rows:
+            break
+        connection.execute(text("UPDATE move_list SET checkpoints = :checkpoints WHERE game_id = :game_id"),
+                           [{"game_id": game_id, "checkpoints": build_checkpoints(moves)} for game_id, moves in rows])
+        after = rows[-1][0]
+
+def add_game_history_indexes(connection):
+    """Replace the per-player indexes with covering history indexes"""
+    indexes = {
+        'game': [('ix_game_white_result', 'ix_game_white_history',
+                  'white_player_id, is_finished, updated_at, id, black_player_id, winner_id, timeout_user_id'),
+                 ('ix_game_black_result', 'ix_game_black_history',
+                  'black_player_id, is_finished, updated_at, id, white_player_id, winner_id, timeout_user_id')],
+        'archived_game': [('ix_archived_game_white', 'ix_archived_game_white_history',
+                           'white_player_id, finished_at, game_id, black_player_id, winner_id, timeout_user_id'),
+                          ('ix_archived_game_black', 'ix_archived_game_black_history',
+                           'black_player_id, finished_at, game_id, white_player_id, winner_id, timeout_user_id')],
+    }
+    for table, replacements in indexes.items():
+        existing = {index['name'] for index in inspect(connection).get_indexes(table)}
+        for old_name, name, columns in replacements:
+            if name not in existing:
+                connection.execute(text(f"CREATE INDEX {name} ON {table} ({columns})"))
+                print(f"Added {name} index to {table} table")
+            if old_name in existing:
+                connection.execute(text(f"DROP INDEX {old_name}"))
+
+def add_premoves(connection):
+    """Add the premove table"""
+    Premove.__table__.create(connection, checkfirst=True)
+
+def add_engine_search_stats(connection):
+    """Add the column holding the engine's last search statistics"""
+    add_missing_columns(connection, 'game', [('engine_search', 'TEXT')])
+
+# (version, migration) in order; append new migrations here
+MIGRATIONS = [
+    (1, migrate_unversioned_schema),
+    (2, add_player_clocks),
+    (3, add_player_result_indexes),
+    (4, add_queue_heartbeat),
+    (5, add_move_list_checkpoints),
+    (6, add_game_history_indexes),
+    (7, add_premoves),
+    (8, add_engine_search_stats),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(connection):
+    """Return the schema version recorded in the database, or None if it has none"""
+    if not inspect(connection).has_table('schema_version'):
+        return None
+    return connection.execute(text("SELECT version FROM schema_version")).scalar()
+
+def upgrade_database():
+    """Apply pending migrations, each in its own transaction; returns (previous version, current version)"""
+    with db.engine.begin() as connection:
+        current = get_schema_version(connection)
+        if current is None:
+            connection.execute(text("CREATE TABLE schema_version (version INTEGER NOT NULL)"))
+            if not inspect(connection).has_table('game'):
+                db.metadata.create_all(connection)
+                connection.execute(text("INSERT INTO schema_version (version) VALUES (:version)"),
+                                   {"version": SCHEMA_VERSION})
+                return None, SCHEMA_VERSION
+            connection.execute(text("INSERT INTO schema_version (version) VALUES (0)"))
+            current = 0
+    
+    previous = current
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        with db.engine.begin() as connection:
+            migration(connection)
+            # Fails if another process applied this migration concurrently; the transaction rolls back
+            updated = connection.execute(text("UPDATE schema_version SET version = :version WHERE version = :current"),
+                                         {"version": version, "current": current})
+            if updated.rowcount != 1:
+                raise RuntimeError(f"Schema version changed while applying migration {version}")
+        print(f"Applied migration {version}: {migration.__doc__}")
+        current = version
+    return previous, current
+
+@bp.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create or upgrade the database schema"""
+    previous, current = upgrade_database()
+    if previous == current:
+        click.echo(f"Database schema is up to date (version {current})")
+    elif previous is None:
+        click.echo(f"Created database schema (version {current})")
+    else:
+        click.echo(f"Upgraded database schema from version {previous} to {current}")
+
+# Flag fall
+def settle_flag_fall(game, now=None):
+    """End the game if the side to move has run out of time; returns True if it did"""
+    if not game.has_flagged(now):
+        return False
+    if game.current_turn == 'white':
+        game.winner_id, game.timeout_user_id = game.black_player_id, game.white_player_id
+    else:
+        game.winner_id, game.timeout_user_id = game.white_player_id, game.black_player_id
+    print(f"Game {game.id}: {display_name(game.timeout_user_id)} ran out of time")
+    handle_game_end(game.id, game.winner_id, "timeout")
+    return True
+
+def check_for_timeouts(app):
+    """Background task that ends games when a clock runs out, sleeping until the next flag deadline"""
+    print("Starting flag-fall scheduler background task...")
     while True:
         try:
             with app.app_context():
-                # Get all active games
-                active_games = Game.query.filter_by(is_finished=False).all()
-                print(f"Checking {len(active_games)} active games for timeouts...")
-                for game in active_games:
-                    # Check for timeout
-                    if game.check_timeout():
-                        print(f"Game {game.id} timed out - marked as finished")
-                        # Update statistics via handle_game_end
-                        handle_game_end(game.id, game.winner_id, "timeout")
-            
-            # Check every 10 seconds
-            time.sleep(10)
+                now = datetime.utcnow()
+                for game in Game.query.filter(Game.flag_deadline <= now, Game.is_finished == False).all():
+                    try:
+                        settle_flag_fall(game, now)
+                    except StaleDataError:
+                        # A move or another worker got there first; the deadline is re-read next round
+                        db.session.rollback()
+                next_deadline = (db.session.query(func.min(Game.flag_deadline))
+                                 .filter(Game.is_finished == False)
+                                 .scalar())
+                wait = app.config['FLAG_CHECK_SECONDS']
+            if next_deadline is not None:
+                wait = min(wait, max(0.05, (next_deadline - datetime.utcnow()).total_seconds()))
+            time.sleep(wait)
         except Exception as e:
-            print(f"Error in timeout checker: {e}")
+            print(f"Error in flag-fall scheduler: {e}")
             time.sleep(30)  # If there's an error, wait longer before retrying
 
-@app.route('/')
+def clock_state(game, now=None):
+    """Both players' remaining time in seconds and which clock is running"""
+    if game.white_clock_ms is None:
+        return None
+    now = now or datetime.utcnow()
+    return {
+        "white": round(game.clock_ms('white', now) / 1000, 1),
+        "black": round(game.clock_ms('black', now) / 1000, 1),
+        "running": None if game.is_finished else game.current_turn,
+        "increment": (game.clock_increment_ms or 0) / 1000
+    }
+
+@bp.route('/')
 def home():
-    if 'user_id' in session:
-        user = User.query.get(session['user_id'])
+    user = get_current_user()
+    if user:
         # Check if user has an active game
         active_game = Game.query.filter(
             (Game.white_player_id == user.id) | (Game.black_player_id == user.id),
             Game.is_finished == False
         ).first()
         
-        # Get recent games (both as white and black)
-        recent_games = Game.query.filter(
-            ((Game.white_player_id == user.id) | (Game.black_player_id == user.id)),
-            Game.is_finished == True
-        ).order_by(Game.updated_at.desc()).limit(10).all()
+        # Last 10 finished games, hot or archived
+        finished_games, _ = player_game_page(user.id, 10)
         
         # Process game data to display results
         game_history = []
-        for game in recent_games:
+        for finished_at, game_id, white_player_id, black_player_id, winner_id, timeout_user_id in finished_games:
             game_data = {
-                'id': game.id,
-                'date': game.updated_at.strftime('%Y-%m-%d %H:%M'),
-                'opponent': game.black_player.name if game.white_player_id == user.id else game.white_player.name,
-                'player_color': 'white' if game.white_player_id == user.id else 'black',
+                'id': game_id,
+                'date': finished_at.strftime('%Y-%m-%d %H:%M'),
+                'opponent': display_name(black_player_id if white_player_id == user.id else white_player_id),
+                'player_color': 'white' if white_player_id == user.id else 'black',
             }
             
             # Determine game result from user's perspective
-            if game.winner_id is None:
+            if winner_id is None:
                 game_data['result'] = 'Draw'
                 game_data['result_class'] = 'draw'
-            elif game.winner_id == user.id:
+            elif winner_id == user.id:
                 game_data['result'] = 'Win'
                 game_data['result_class'] = 'win'
             else:
@@ -275,8 +1019,8 @@ def home():
                 game_data['result_class'] = 'loss'
                 
             # Add timeout info if available
-            if game.timeout_user_id is not None:
-                if game.timeout_user_id == user.id:
+            if timeout_user_id is not None:
+                if timeout_user_id == user.id:
                     game_data['timeout'] = 'You timed out'
                 else:
                     game_data['timeout'] = 'Opponent timed out'
@@ -286,12 +1030,93 @@ def home():
         return render_template('home.html', user=user, active_game=active_game, game_history=game_history)
     return render_template('home.html')
 
-@app.route('/leaderboard')
+# Keyset cursors: opaque tokens for a (timestamp, game id) position in an ordered listing
+def encode_keyset_cursor(timestamp, game_id):
+    """Encode an opaque resume token for a (timestamp, game id) keyset ordering"""
+    raw = f"{timestamp.isoformat()}|{game_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_keyset_cursor(token):
+    """Decode a token produced by encode_keyset_cursor into (timestamp, game id) (raises ValueError)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        timestamp, game_id = raw.split('|', 1)
+        return datetime.fromisoformat(timestamp), game_id
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+
+# Player game history
+GAME_HISTORY_PAGE_SIZE = 20
+GAME_HISTORY_MAX_PAGE_SIZE = 100
+
+def player_game_page(user_id, limit, cursor=None):
+    """One keyset page of a player's finished games, newest first; returns (rows, next cursor or None)"""
+    sources = [
+        (Game.updated_at, Game.id, Game.white_player_id, Game.black_player_id, Game.winner_id,
+         Game.timeout_user_id, Game.is_finished == True),
+        (ArchivedGame.finished_at, ArchivedGame.game_id, ArchivedGame.white_player_id, ArchivedGame.black_player_id,
+         ArchivedGame.winner_id, ArchivedGame.timeout_user_id, None),
+    ]
+    pages = []
+    for finished_at, game_id, white_id, black_id, winner_id, timeout_user_id, condition in sources:
+        for player_column in (white_id, black_id):
+            stmt = select(finished_at, game_id, white_id, black_id, winner_id, timeout_user_id).where(player_column == user_id)
+            if condition is not None:
+                stmt = stmt.where(condition)
+            if cursor is not None:
+                cursor_at, cursor_id = cursor
+                # The first clause bounds the index range; the second breaks ties on the same timestamp
+                stmt = stmt.where(finished_at <= cursor_at, or_(finished_at < cursor_at, game_id < cursor_id))
+            stmt = stmt.order_by(finished_at.desc(), game_id.desc()).limit(limit + 1)
+            pages.append(db.session.execute(stmt).all())
+    
+    rows = list(itertools.islice(heapq.merge(*pages, key=lambda row: (row[0], row[1]), reverse=True), limit + 1))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1][0], rows[-1][1])
+
+@bp.route('/api/users/<int:user_id>/games', methods=['GET'])
+def user_games(user_id):
+    """Return a page of a player's finished games (?limit=N&cursor=...)"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not authenticated"}), 401
+    if db.session.get(User, user_id) is None:
+        return jsonify({"error": "User not found"}), 404
+    
+    limit = request.args.get('limit', GAME_HISTORY_PAGE_SIZE, type=int)
+    if limit < 1 or limit > GAME_HISTORY_MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {GAME_HISTORY_MAX_PAGE_SIZE}"}), 400
+    try:
+        cursor = decode_keyset_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    rows, next_cursor = player_game_page(user_id, limit, cursor)
+    games = []
+    for finished_at, game_id, white_id, black_id, winner_id, timeout_user_id in rows:
+        opponent_id = black_id if white_id == user_id else white_id
+        games.append({
+            "id": game_id,
+            "finished_at": finished_at.isoformat(),
+            "color": 'white' if white_id == user_id else 'black',
+            "opponent_id": opponent_id,
+            "opponent": display_name(opponent_id),
+            "result": 'draw' if winner_id is None else ('win' if winner_id == user_id else 'loss'),
+            "timeout_user_id": timeout_user_id
+        })
+    return jsonify({
+        "user_id": user_id,
+        "games": games,
+        "next_cursor": encode_keyset_cursor(*next_cursor) if next_cursor else None
+    })
+
+@bp.route('/leaderboard')
 def leaderboard():
     """Display the top 30 players based on win rate and games played"""
     # Get all users with at least 3 games played to avoid skewed stats
     min_games = 3
-    users = User.query.filter(User.games_played >= min_games).all()
+    users = User.query.filter(User.games_played >= min_games, User.is_engine == False).all()
     
     # Sort users by win rate in descending order
     ranked_users = sorted(users, key=lambda user: user.win_rate(), reverse=True)
@@ -300,7 +1125,7 @@ def leaderboard():
     top_players = ranked_users[:30]
     
     # Get additional players with games played but not in top 30
-    other_users = User.query.filter(User.games_played > 0, User.games_played < min_games).all()
+    other_users = User.query.filter(User.games_played > 0, User.games_played < min_games, User.is_engine == False).all()
     
     # Sort these by games played in descending order
     other_players = sorted(other_users, key=lambda user: user.games_played, reverse=True)
@@ -324,16 +1149,16 @@ def leaderboard():
     
     return render_template('leaderboard.html', players=players_with_rank, min_games=min_games)
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         name = request.form['name']
         password = request.form['password']
         
         user_exists = User.query.filter_by(name=name).first()
-        if user_exists:
+        if user_exists or name == ENGINE_USER_NAME:
             flash('Username already exists')
-            return redirect(url_for('register'))
+            return redirect(url_for('chess.register'))
         
         hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
         new_user = User(name=name, password=hashed_password)
@@ -342,11 +1167,11 @@ def register():
         db.session.commit()
         
         flash('Registration successful! Please log in.')
-        return redirect(url_for('login'))
+        return redirect(url_for('chess.login'))
     
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         name = request.form['name']
@@ -356,14 +1181,14 @@ def login():
         
         if not user or not check_password_hash(user.password, password):
             flash('Please check your login details and try again.')
-            return redirect(url_for('login'))
+            return redirect(url_for('chess.login'))
         
         session['user_id'] = user.id
-        return redirect(url_for('home'))
+        return redirect(url_for('chess.home'))
     
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     if 'user_id' in session:
         user_id = session['user_id']
@@ -379,22 +1204,62 @@ def logout():
             # Determine the winner (opponent of the user who logged out)
             winner_id = active_game.black_player_id if active_game.white_player_id == user_id else active_game.white_player_id
             
-            # Update game status
-            active_game.is_finished = True
-            active_game.winner_id = winner_id
-            db.session.commit()
+            # Finish through handle_game_end so both players' statistics are updated
+            try:
+                handle_game_end(active_game.id, winner_id, "forfeit")
+            except StaleDataError:
+                # The game changed (or ended) first; the clock still settles it if it is left open
+                db.session.rollback()
     
     # Clear session
     session.pop('user_id', None)
-    return redirect(url_for('home'))
+    return redirect(url_for('chess.home'))
+
+# Queue heartbeats
+# A waiting player's status polls keep their queue entry alive. Entries whose
+# heartbeat is older than QUEUE_TTL_SECONDS belong to a closed tab: the matcher
+# skips them and the sweeper deletes them.
+def queue_cutoff(now=None):
+    """Oldest heartbeat a queue entry can have and still be matched"""
+    return (now or datetime.utcnow()) - timedelta(seconds=current_app.config['QUEUE_TTL_SECONDS'])
+
+def refresh_queue_heartbeat(entry, now=None):
+    """Mark a waiting player as present, writing at most every QUEUE_HEARTBEAT_SECONDS"""
+    now = now or datetime.utcnow()
+    if entry.last_seen_at and now - entry.last_seen_at < timedelta(seconds=current_app.config['QUEUE_HEARTBEAT_SECONDS']):
+        return
+    # A plain UPDATE: if the entry was just matched or swept there is simply nothing to refresh
+    db.session.execute(update(Queue).where(Queue.id == entry.id).values(last_seen_at=now)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+
+def evict_stale_queue_entries(now=None):
+    """Delete queue entries whose heartbeat expired, found through the last_seen_at index"""
+    evicted = Queue.query.filter(Queue.last_seen_at < queue_cutoff(now)).delete(synchronize_session=False)
+    db.session.commit()
+    return evicted
+
+def sweep_queue(app):
+    """Background task that evicts abandoned queue entries every QUEUE_SWEEP_SECONDS"""
+    print("Starting queue sweeper background task...")
+    while True:
+        try:
+            with app.app_context():
+                evicted = evict_stale_queue_entries()
+            if evicted:
+                print(f"Evicted {evicted} stale queue entries")
+            time.sleep(app.config['QUEUE_SWEEP_SECONDS'])
+        except Exception as e:
+            print(f"Error in queue sweeper: {e}")
+            time.sleep(30)
 
 # Chess Game API Routes
 
-@app.route('/join-queue', methods=['POST'])
+@bp.route('/join-queue', methods=['POST'])
 def join_queue():
     if 'user_id' not in session:
         flash('You must be logged in to join a game')
-        return redirect(url_for('login'))
+        return redirect(url_for('chess.login'))
     
     user_id = session['user_id']
     
@@ -406,26 +1271,28 @@ def join_queue():
     
     if active_game:
         # Redirect to the existing game
-        return redirect(url_for('game_page', game_id=active_game.id))
+        return redirect(url_for('chess.game_page', game_id=active_game.id))
     
     # Check if user is already in queue
     existing_queue = Queue.query.filter_by(user_id=user_id).first()
     if existing_queue:
         # Already in queue, redirect to waiting page
-        return redirect(url_for('waiting_page'))
+        return redirect(url_for('chess.waiting_page'))
     
-    # Find another player in the queue
-    opponent = Queue.query.order_by(Queue.joined_at.asc()).first()
+    # Find another player in the queue, skipping anyone who stopped polling
+    opponent = (Queue.query
+                .filter(Queue.last_seen_at >= queue_cutoff())
+                .order_by(Queue.joined_at.asc())
+                .first())
     
     if opponent and opponent.user_id != user_id:
         # Match found! Create a game with this player
-        opponent_user = User.query.get(opponent.user_id)
-        
         # Create a new game
         new_game = Game(
             white_player_id=opponent.user_id,
             black_player_id=user_id
         )
+        new_game.start_clock(current_app.config['CLOCK_BASE_SECONDS'], current_app.config['CLOCK_INCREMENT_SECONDS'])
         
         # Remove opponent from queue
         db.session.delete(opponent)
@@ -439,7 +1306,7 @@ def join_queue():
         db.session.commit()
         
         # Redirect to game page
-        return redirect(url_for('game_page', game_id=new_game.id))
+        return redirect(url_for('chess.game_page', game_id=new_game.id))
     else:
         # No opponent found, add to queue
         new_queue_entry = Queue(user_id=user_id)
@@ -447,13 +1314,13 @@ def join_queue():
         db.session.commit()
         
         # Redirect to waiting page
-        return redirect(url_for('waiting_page'))
+        return redirect(url_for('chess.waiting_page'))
 
-@app.route('/waiting')
+@bp.route('/waiting')
 def waiting_page():
     if 'user_id' not in session:
         flash('You must be logged in to join a game')
-        return redirect(url_for('login'))
+        return redirect(url_for('chess.login'))
     
     user_id = session['user_id']
     
@@ -461,7 +1328,7 @@ def waiting_page():
     in_queue = Queue.query.filter_by(user_id=user_id).first()
     if not in_queue:
         flash('You are not in the queue')
-        return redirect(url_for('home'))
+        return redirect(url_for('chess.home'))
     
     # Check if user has an active game (might have been matched while loading this page)
     active_game = Game.query.filter(
@@ -471,17 +1338,18 @@ def waiting_page():
     
     if active_game:
         # Found a game, redirect to it
-        return redirect(url_for('game_page', game_id=active_game.id))
+        return redirect(url_for('chess.game_page', game_id=active_game.id))
+    
+    refresh_queue_heartbeat(in_queue)
     
     # Render the waiting page
-    user = User.query.get(user_id)
-    return render_template('waiting.html', user=user)
+    return render_template('waiting.html', user=get_current_user())
 
-@app.route('/leave-queue', methods=['POST'])
+@bp.route('/leave-queue', methods=['POST'])
 def leave_queue():
     if 'user_id' not in session:
         flash('You must be logged in')
-        return redirect(url_for('login'))
+        return redirect(url_for('chess.login'))
     
     user_id = session['user_id']
     
@@ -494,9 +1362,90 @@ def leave_queue():
         db.session.commit()
         flash('You have left the queue')
     
-    return redirect(url_for('home'))
+    return redirect(url_for('chess.home'))
+
+# Poll pacing
+class TokenBucketLimiter:
+    """Per-key token buckets kept in memory, evicting idle keys LRU-first"""
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def allow(self, key, rate, burst):
+        """Spend a token for key; returns (allowed, seconds until the next token)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+class PollLoad:
+    """Polls served by this process over the last full second"""
+    def __init__(self):
+        self._second = 0
+        self._count = 0
+        self._last_rate = 0
+        self._lock = threading.Lock()
+    
+    def record(self):
+        second = int(time.monotonic())
+        with self._lock:
+            if second != self._second:
+                self._last_rate = self._count if second == self._second + 1 else 0
+                self._second, self._count = second, 0
+            self._count += 1
+    
+    def rate(self):
+        with self._lock:
+            return self._last_rate if int(time.monotonic()) <= self._second + 1 else 0
+
+poll_limiter = TokenBucketLimiter()
+poll_load = PollLoad()
+
+def next_poll_ms(waiting_for_opponent=True, waited_seconds=0, remaining_seconds=None):
+    """Suggest when a client should poll again, backing off with think time and server load"""
+    config = current_app.config
+    if waiting_for_opponent:
+        interval = config['POLL_MIN_MS'] + 100 * waited_seconds
+    else:
+        interval = config['POLL_OWN_TURN_MS']
+    interval *= max(1.0, poll_load.rate() / config['POLL_TARGET_RATE'])
+    if remaining_seconds is not None:
+        interval = min(interval, remaining_seconds * 1000 + 250)
+    return int(min(max(interval, config['POLL_MIN_MS']), config['POLL_MAX_MS']))
+
+def poll_response(data, interval_ms, status=200):
+    """JSON poll response carrying the next poll hint in the body and as Retry-After"""
+    data["next_poll_ms"] = interval_ms
+    response = jsonify(data)
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(interval_ms / 1000)))
+    return response
+
+def rate_limited_poll(view):
+    """Reject sessions that poll faster than their token bucket allows, before any database work"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = session.get('user_id') or request.remote_addr
+        allowed, retry_after = poll_limiter.allow(key, current_app.config['POLL_BUCKET_RATE'],
+                                                  current_app.config['POLL_BUCKET_BURST'])
+        if not allowed:
+            interval = max(int(retry_after * 1000), current_app.config['POLL_MIN_MS'])
+            return poll_response({"error": "Polling too fast"}, interval, 429)
+        poll_load.record()
+        return view(*args, **kwargs)
+    return wrapper
 
-@app.route('/api/check-status')
+@bp.route('/api/check-status')
+@rate_limited_poll
 def check_status():
     if 'user_id' not in session:
         return jsonify({"error": "You must be logged in"}), 401
@@ -518,22 +1467,25 @@ def check_status():
         
         your_color = "white" if active_game.white_player_id == user_id else "black"
         opponent_id = active_game.black_player_id if your_color == "white" else active_game.white_player_id
-        opponent = User.query.get(opponent_id)
+        opponent_name = display_name(opponent_id)
         
-        return jsonify({
+        return poll_response({
             "status": "game_started",
             "game_id": active_game.id,
             "your_color": your_color,
-            "opponent": opponent.name if opponent else "Unknown Player"
-        })
+            "opponent": opponent_name or "Unknown Player"
+        }, current_app.config['POLL_MAX_MS'])
     
     # Check if user is still in queue
     in_queue = Queue.query.filter_by(user_id=user_id).first()
     if in_queue:
-        return jsonify({
+        refresh_queue_heartbeat(in_queue)
+        # A match can come at any moment: poll at the base rate, scaled by load,
+        # but often enough that the heartbeat never expires
+        return poll_response({
             "status": "waiting",
             "message": "Still waiting for an opponent"
-        })
+        }, min(next_poll_ms(), current_app.config['QUEUE_HEARTBEAT_SECONDS'] * 1000))
     
     # User is neither in a game nor in queue
     return jsonify({
@@ -541,23 +1493,23 @@ def check_status():
         "message": "You are not in queue or game"
     })
 
-@app.route('/game/<game_id>')
+@bp.route('/game/<game_id>')
 def game_page(game_id):
     if 'user_id' not in session:
         flash('Please login to play', 'error')
-        return redirect(url_for('login'))
+        return redirect(url_for('chess.login'))
     
     user_id = session['user_id']
-    user = User.query.get(user_id)
+    user = get_current_user()
     game = Game.query.get(game_id)
     
     if not game:
         flash('Game not found', 'error')
-        return redirect(url_for('home'))
+        return redirect(url_for('chess.home'))
     
     if game.white_player_id != user_id and game.black_player_id != user_id:
         flash('You are not a participant in this game', 'error')
-        return redirect(url_for('home'))
+        return redirect(url_for('chess.home'))
     
     # Remove user from queue if they're still in it
     user_in_queue = Queue.query.filter_by(user_id=user_id).first()
@@ -565,23 +1517,23 @@ def game_page(game_id):
         db.session.delete(user_in_queue)
         db.session.commit()
     
-    # Check if the game has timed out
-    game.check_timeout()
+    # Resume the computer opponent if its search was lost (e.g. after a restart)
+    if not game.is_finished and is_engine_turn(game):
+        schedule_engine_move(game)
     
     your_color = 'white' if game.white_player_id == user_id else 'black'
     opponent_id = game.black_player_id if your_color == 'white' else game.white_player_id
-    opponent = User.query.get(opponent_id)
     
     return render_template('game.html', 
                           game_id=game_id, 
                           your_color=your_color, 
-                          opponent=opponent.name,
+                          opponent=display_name(opponent_id),
                           turn=game.current_turn,
                           user=user,
                           is_finished=game.is_finished,
                           winner_id=game.winner_id)
 
-@app.route('/api/game-status/<game_id>', methods=['GET'])
+@bp.route('/api/game-status/<game_id>', methods=['GET'])
 def game_status(game_id):
     if 'user_id' not in session:
         return jsonify({"error": "You must be logged in to view game status"}), 401
@@ -597,7 +1549,6 @@ def game_status(game_id):
     
     user_color = "white" if game.white_player_id == user_id else "black"
     opponent_id = game.black_player_id if user_color == "white" else game.white_player_id
-    opponent = User.query.get(opponent_id)
     
     board = json.loads(game.board_state)
     
@@ -608,29 +1559,267 @@ def game_status(game_id):
     winner_name = None
     timeout_info = None
     if game.is_finished and game.winner_id:
-        winner = User.query.get(game.winner_id)
-        winner_name = winner.name if winner else None
+        winner_name = display_name(game.winner_id)
         
         # If game ended due to timeout, include that info
         if game.timeout_user_id:
-            timeout_user = User.query.get(game.timeout_user_id)
-            if timeout_user:
-                timeout_info = f"{timeout_user.name} timed out"
+            timeout_name = display_name(game.timeout_user_id)
+            if timeout_name:
+                timeout_info = f"{timeout_name} timed out"
     
     response = {
         "game_id": game.id,
+        "version": game.version,
         "your_color": user_color,
-        "opponent": opponent.name,
+        "opponent": display_name(opponent_id),
         "board": board,
         "turn": game.current_turn,
         "is_finished": game.is_finished,
         "in_check": in_check,
         "winner": winner_name,
-        "timeout_info": timeout_info
+        "timeout_info": timeout_info,
+        "clock": clock_state(game),
+        "legal_moves": legal_move_cache.get(game, board)
     }
     
     return jsonify(response), 200
 
+@bp.route('/api/game-sync/<game_id>', methods=['GET'])
+@rate_limited_poll
+def game_sync(game_id):
+    """Single read-only poll for the game page; the board is only sent when it changed since `since`"""
+    if 'user_id' not in session:
+        return jsonify({"authenticated": False, "error": "Not authenticated"}), 401
+    
+    user_id = session['user_id']
+    winner = aliased(User)
+    timeout_user = aliased(User)
+    row = (db.session.query(Game, winner.name, timeout_user.name)
+           .outerjoin(winner, winner.id == Game.winner_id)
+           .outerjoin(timeout_user, timeout_user.id == Game.timeout_user_id)
+           .filter(Game.id == game_id)
+           .first())
+    
+    if row is None:
+        return jsonify({"error": "Game not found"}), 404
+    game, winner_name, timeout_name = row
+    
+    if game.white_player_id != user_id and game.black_player_id != user_id:
+        return jsonify({"error": "You are not a participant in this game"}), 403
+    
+    user_color = "white" if game.white_player_id == user_id else "black"
+    now = datetime.utcnow()
+    turn_elapsed = (now - game.turn_started_at).total_seconds() if game.turn_started_at else 0
+    remaining_ms = game.clock_ms(game.current_turn, now)
+    
+    response = {
+        "authenticated": True,
+        "game_id": game.id,
+        "version": game.version,
+        "turn": game.current_turn,
+        "your_color": user_color,
+        "your_turn": not game.is_finished and game.current_turn == user_color,
+        "is_finished": game.is_finished,
+        "winner": winner_name if game.is_finished else None,
+        "timed_out": game.timeout_user_id is not None,
+        "timeout_info": f"{timeout_name} timed out" if timeout_name else None,
+        "clock": clock_state(game, now),
+        "remaining_seconds": None if game.is_finished or remaining_ms is None else round(remaining_ms / 1000, 1)
+    }
+    
+    if game.engine_search and not game.is_finished:
+        response["engine"] = json.loads(game.engine_search)
+    
+    # Only ship the board when the client's copy is out of date
+    if request.args.get('since', type=int) != game.version:
+        board = json.loads(game.board_state)
+        response["board"] = board
+        response["in_check"] = is_in_check(game.current_turn, board)
+        response["legal_moves"] = legal_move_cache.get(game, board) if response["your_turn"] else {}
+        # Lets the page drop its premove once the server has played or rejected it
+        pending = db.session.get(Premove, game.id)
+        response["pending_premove"] = ({"from": pending.from_position, "to": pending.to_position}
+                                       if pending is not None and pending.user_id == user_id else None)
+    
+    if game.is_finished:
+        interval = current_app.config['POLL_MAX_MS']
+    else:
+        interval = next_poll_ms(waiting_for_opponent=not response["your_turn"],
+                                waited_seconds=turn_elapsed,
+                                remaining_seconds=response["remaining_seconds"])
+    return poll_response(response, interval)
+
+@bp.route('/api/legal-moves/<game_id>', methods=['GET'])
+def legal_moves(game_id):
+    """Return every legal move for the side to move, for client-side highlighting"""
+    if 'user_id' not in session:
+        return jsonify({"error": "You must be logged in to view legal moves"}), 401
+    
+    user_id = session['user_id']
+    game = Game.query.get(game_id)
+    
+    if not game:
+        return jsonify({"error": "Game not found"}), 404
+    
+    if game.white_player_id != user_id and game.black_player_id != user_id:
+        return jsonify({"error": "You are not a participant in this game"}), 403
+    
+    return jsonify({
+        "game_id": game.id,
+        "version": game.version,
+        "turn": game.current_turn,
+        "is_finished": game.is_finished,
+        "legal_moves": legal_move_cache.get(game)
+    }), 200
+
+# Spectator mode
+# Immutable serialized view of one game version shared by all spectators
+SpectatorSnapshot = namedtuple('SpectatorSnapshot', ['version', 'body', 'gzipped', 'etag', 'is_finished'])
+
+def build_spectator_snapshot(game):
+    """Serialize the public state of a game exactly once for its current version"""
+    board = json.loads(game.board_state)
+    winner_name = None
+    timeout_info = None
+    if game.is_finished and game.winner_id:
+        winner_name = display_name(game.winner_id)
+        if game.timeout_user_id:
+            timeout_info = f"{display_name(game.timeout_user_id)} timed out"
+    
+    body = json.dumps({
+        "game_id": game.id,
+        "version": game.version,
+        "white": display_name(game.white_player_id),
+        "black": display_name(game.black_player_id),
+        "board": board,
+        "turn": game.current_turn,
+        "is_finished": game.is_finished,
+        "in_check": is_in_check(game.current_turn, board),
+        "winner": winner_name,
+        "timeout_info": timeout_info,
+        "clock": None if game.white_clock_ms is None else {
+            "white": game.white_clock_ms / 1000,
+            "black": game.black_clock_ms / 1000,
+            "running": None if game.is_finished else game.current_turn,
+            "turn_started_at": game.turn_started_at.isoformat() + 'Z' if game.turn_started_at else None
+        }
+    }, separators=(',', ':')).encode()
+    # Compressed once per version here, rather than per watcher by compress_response
+    gzipped = gzip.compress(body, compresslevel=6, mtime=0) if len(body) >= COMPRESS_MIN_BYTES else None
+    return SpectatorSnapshot(game.version, body, gzipped, f"{game.id}-{game.version}", game.is_finished)
+
+class SpectatorSnapshotCache:
+    """Per-game snapshot cache that makes watchers share one serialization"""
+    def __init__(self, maxsize=1024, lock_stripes=64):
+        self._entries = LRUCache(maxsize)  # game_id -> [snapshot, checked_at]
+        # A fixed pool of refresh locks shared by hash, so unknown ids cannot grow it
+        self._locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def _game_lock(self, game_id):
+        return self._locks[hash(game_id) % len(self._locks)]
+
+    def get(self, game_id):
+        """Return the current snapshot for game_id, or None if the game does not exist"""
+        refresh_seconds = current_app.config['SPECTATOR_REFRESH_SECONDS']
+        entry = self._entries.get(game_id)
+        if entry is not None and time.monotonic() - entry[1] < refresh_seconds:
+            return entry[0]
+        
+        with self._game_lock(game_id):
+            # Another watcher may have refreshed it while we waited
+            entry = self._entries.get(game_id)
+            if entry is not None and time.monotonic() - entry[1] < refresh_seconds:
+                return entry[0]
+            
+            version = db.session.query(Game.version).filter(Game.id == game_id).scalar()
+            if version is None:
+                return None
+            if entry is not None and entry[0].version == version:
+                entry[1] = time.monotonic()
+                return entry[0]
+            
+            snapshot = build_spectator_snapshot(Game.query.get(game_id))
+            self._entries.put(game_id, [snapshot, time.monotonic()])
+            return snapshot
+
+spectator_snapshots = SpectatorSnapshotCache()
+
+@bp.route('/api/spectate/<game_id>', methods=['GET'])
+def spectate_game(game_id):
+    """Return the shared public snapshot of a game (supports If-None-Match)"""
+    snapshot = spectator_snapshots.get(game_id)
+    if snapshot is None:
+        return jsonify({"error": "Game not found"}), 404
+    
+    if snapshot.gzipped is not None and 'gzip' in request.accept_encodings:
+        response = Response(snapshot.gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(snapshot.etag, weak=True)
+    else:
+        response = Response(snapshot.body, mimetype='application/json')
+        response.set_etag(snapshot.etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 0 if not snapshot.is_finished else 3600
+    if not snapshot.is_finished:
+        # Watchers poll with If-None-Match; snapshots never change faster than SPECTATOR_REFRESH_SECONDS
+        interval_ms = max(next_poll_ms(), current_app.config['SPECTATOR_REFRESH_SECONDS'] * 1000)
+        response.headers['Retry-After'] = str(max(1, math.ceil(interval_ms / 1000)))
+    return response.make_conditional(request)
+
+# Game replay
+class ReplayCache:
+    """LRU cache of packed positions keyed by (game id, ply), which never change once played"""
+    def __init__(self, maxsize=4096):
+        self._entries = LRUCache(maxsize)
+    
+    def get(self, game_id, ply):
+        packed = self._entries.get((game_id, ply))
+        return unpack_position(packed) if packed is not None else None
+    
+    def put(self, game_id, ply, board):
+        self._entries.put((game_id, ply), pack_position(board))
+
+replay_cache = ReplayCache()
+
+def seek_position(game_id, move_list, ply):
+    """Board after `ply` plies: from the cache, else from the nearest checkpoint"""
+    board = replay_cache.get(game_id, ply)
+    if board is not None:
+        return board
+    previous = replay_cache.get(game_id, ply - 1) if ply else None
+    board = move_list.position_at(ply, start=(ply - 1, previous) if previous is not None else None)
+    replay_cache.put(game_id, ply, board)
+    return board
+
+@bp.route('/api/replay/<game_id>', methods=['GET'])
+def replay_game(game_id):
+    """Return the position of a game after any ply (?ply=N, default the last)"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    move_list = load_analysis_move_list(game_id)
+    if move_list is None:
+        return jsonify({"error": "Game not found"}), 404
+    
+    ply_count = move_list.ply_count or 0
+    ply = request.args.get('ply', ply_count, type=int)
+    if ply < 0 or ply > ply_count:
+        return jsonify({"error": f"ply must be between 0 and {ply_count}"}), 400
+    
+    last_move = None
+    if ply:
+        from_pos, to_pos = decode_move(struct.unpack_from('<H', move_list.moves, 2 * (ply - 1))[0])
+        last_move = {"from": from_pos, "to": to_pos}
+    return jsonify({
+        "game_id": game_id,
+        "ply": ply,
+        "ply_count": ply_count,
+        "turn": 'white' if ply % 2 == 0 else 'black',
+        "last_move": last_move,
+        "board": seek_position(game_id, move_list, ply)
+    })
+
 # Chess rules helper functions
 def is_valid_move(piece, from_pos, to_pos, board):
     """
@@ -794,64 +1983,145 @@ def is_in_check(color, board):
     opponent_color = "black" if color == "white" else "white"
     
     # Check if any opponent's piece can capture the king
-    for pos, piece in board.items():
-        if piece.startswith(opponent_color):
-            if is_valid_move(piece, pos, king_pos, board):
-                return True
+    return is_square_attacked(king_pos, opponent_color, board)
+
+def is_square_attacked(square, by_color, board):
+    """Check if any piece of by_color could capture on square, scanning outward from it"""
+    for col_step, row_step in KNIGHT_OFFSETS:
+        pos = offset_square(square, col_step, row_step)
+        if pos and board.get(pos) == f"{by_color}_knight":
+            return True
+    
+    for col_step, row_step in KING_OFFSETS:
+        pos = offset_square(square, col_step, row_step)
+        if pos and board.get(pos) == f"{by_color}_king":
+            return True
+    
+    # Pawns capture diagonally forward, so look one row behind the square
+    pawn_row_step = -1 if by_color == 'white' else 1
+    for col_step in (-1, 1):
+        pos = offset_square(square, col_step, pawn_row_step)
+        if pos and board.get(pos) == f"{by_color}_pawn":
+            return True
+    
+    for directions, attackers in ((ROOK_DIRECTIONS, ('rook', 'queen')), (BISHOP_DIRECTIONS, ('bishop', 'queen'))):
+        for col_step, row_step in directions:
+            pos = offset_square(square, col_step, row_step)
+            while pos:
+                occupant = board.get(pos)
+                if occupant is not None:
+                    occupant_color, occupant_type = occupant.split('_')
+                    if occupant_color == by_color and occupant_type in attackers:
+                        return True
+                    break
+                pos = offset_square(pos, col_step, row_step)
     
     return False
 
 def is_checkmate(color, board):
     """Check if the king of the given color is in checkmate"""
-    # First, check if the king is in check
-    if not is_in_check(color, board):
-        return False
+    # In check and no legal move gets the king out of it
+    return is_in_check(color, board) and not generate_legal_moves(color, board)
+
+def is_stalemate(color, board):
+    """Check if the game is in stalemate for the given color"""
+    # The player is not in check but has no legal moves
+    return not is_in_check(color, board) and not generate_legal_moves(color, board)
+
+KNIGHT_OFFSETS = [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
+KING_OFFSETS = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+ROOK_DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+BISHOP_DIRECTIONS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+SLIDING_DIRECTIONS = {
+    'rook': ROOK_DIRECTIONS,
+    'bishop': BISHOP_DIRECTIONS,
+    'queen': ROOK_DIRECTIONS + BISHOP_DIRECTIONS,
+}
+
+def offset_square(pos, col_step, row_step):
+    """Return the square reached by stepping from pos, or None if it leaves the board"""
+    col = ord(pos[0]) - ord('a') + col_step
+    row = int(pos[1]) + row_step
+    if 0 <= col < 8 and 1 <= row <= 8:
+        return chr(ord('a') + col) + str(row)
+    return None
+
+def candidate_squares(piece, from_pos, board):
+    """Yield the squares a piece may move to under is_valid_move (king safety not checked)"""
+    color, piece_type = piece.split('_')
     
-    # Get all pieces of the given color
-    pieces = [(pos, piece) for pos, piece in board.items() if piece.startswith(color)]
-    
-    # Try all possible moves for each piece
-    for from_pos, piece in pieces:
-        for to_pos in get_all_positions():
-            # Skip if the move is invalid
-            if not is_valid_move(piece, from_pos, to_pos, board):
-                continue
-            
-            # Test if this move would get the king out of check
-            test_board = board.copy()
-            test_board[to_pos] = piece
-            del test_board[from_pos]
-            
-            if not is_in_check(color, test_board):
-                return False  # Found a move that prevents checkmate
-    
-    return True
+    if piece_type == 'pawn':
+        direction = 1 if color == 'white' else -1
+        one_step = offset_square(from_pos, 0, direction)
+        if one_step and one_step not in board:
+            yield one_step
+            start_row = 2 if color == 'white' else 7
+            two_step = offset_square(from_pos, 0, 2 * direction)
+            if int(from_pos[1]) == start_row and two_step not in board:
+                yield two_step
+        for col_step in (-1, 1):
+            target = offset_square(from_pos, col_step, direction)
+            if target and target in board and not board[target].startswith(color):
+                yield target
+    elif piece_type in ('knight', 'king'):
+        offsets = KNIGHT_OFFSETS if piece_type == 'knight' else KING_OFFSETS
+        for col_step, row_step in offsets:
+            target = offset_square(from_pos, col_step, row_step)
+            if target and not board.get(target, '').startswith(color):
+                yield target
+    else:
+        for col_step, row_step in SLIDING_DIRECTIONS[piece_type]:
+            target = offset_square(from_pos, col_step, row_step)
+            while target:
+                occupant = board.get(target)
+                if occupant is None:
+                    yield target
+                elif not occupant.startswith(color):
+                    yield target
+                    break
+                else:
+                    break
+                target = offset_square(target, col_step, row_step)
 
-def is_stalemate(color, board):
-    """Check if the game is in stalemate for the given color"""
-    # The player is not in check but has no legal moves
-    if is_in_check(color, board):
-        return False
-    
-    # Get all pieces of the given color
-    pieces = [(pos, piece) for pos, piece in board.items() if piece.startswith(color)]
-    
-    # Try all possible moves for each piece
-    for from_pos, piece in pieces:
-        for to_pos in get_all_positions():
-            # Skip if the move is invalid
-            if not is_valid_move(piece, from_pos, to_pos, board):
-                continue
-            
-            # Test if this move wouldn't put the king in check
+def generate_legal_moves(color, board):
+    """Return {from_pos: [to_pos, ...]} with every legal move for the given side"""
+    legal_moves = {}
+    for from_pos, piece in board.items():
+        if not piece.startswith(color):
+            continue
+        
+        targets = []
+        for to_pos in candidate_squares(piece, from_pos, board):
+            # Discard moves that would leave the king in check
             test_board = board.copy()
             test_board[to_pos] = piece
             del test_board[from_pos]
-            
             if not is_in_check(color, test_board):
-                return False  # Found a legal move
-    
-    return True
+                targets.append(to_pos)
+        
+        if targets:
+            legal_moves[from_pos] = sorted(targets)
+    return legal_moves
+
+class LegalMoveCache:
+    """LRU cache of legal-move sets keyed by (game id, game version)"""
+    def __init__(self, maxsize=2048):
+        self._entries = LRUCache(maxsize)
+
+    def get(self, game, board=None):
+        """Return the legal moves for the side to move in game"""
+        key = (game.id, game.version)
+        moves = self._entries.get(key)
+        if moves is not None:
+            return moves
+        
+        if board is None:
+            board = json.loads(game.board_state)
+        moves = {} if game.is_finished else generate_legal_moves(game.current_turn, board)
+        self._entries.put(key, moves)
+        return moves
+
+legal_move_cache = LegalMoveCache()
 
 def get_all_positions():
     """Generate all possible positions on the chessboard"""
@@ -861,7 +2131,9 @@ def get_all_positions():
             positions.append(col + str(row))
     return positions
 
-@app.route('/api/make-move/<game_id>', methods=['POST'])
+GAME_UPDATE_RETRIES = 1  # reloads after a version conflict before answering 409
+
+@bp.route('/api/make-move/<game_id>', methods=['POST'])
 def make_move(game_id):
     if 'user_id' not in session:
         return jsonify({"error": "You must be logged in to make a move"}), 401
@@ -872,13 +2144,6 @@ def make_move(game_id):
     if not game:
         return jsonify({"error": "Game not found"}), 404
     
-    if game.is_finished:
-        return jsonify({"error": "Game is already finished"}), 400
-    
-    # Check if the game has timed out
-    if game.check_timeout():
-        return jsonify({"error": "Game has timed out"}), 400
-    
     # Get move data from request
     data = request.get_json()
     from_pos = data.get('from')
@@ -889,136 +2154,247 @@ def make_move(game_id):
         return jsonify({"error": "Invalid move data. Must include 'from', 'to', and 'name'"}), 400
     
     # Verify player identity
-    user = User.query.get(user_id)
+    user = get_current_user()
     if not user or user.name != player_name:
         return jsonify({"error": "Player name does not match authenticated user"}), 403
     
+    for attempt in range(GAME_UPDATE_RETRIES + 1):
+        try:
+            response_data, status = play_move(game, user_id, from_pos, to_pos)
+            break
+        except StaleDataError:
+            # Another request changed the game first: reload it and validate the move again
+            db.session.rollback()
+            game = Game.query.get(game_id)
+    else:
+        return jsonify({"error": "The game was changed by another request, please try again"}), 409
+    
+    # Let the computer opponent reply without holding up this request
+    if status == 200 and not game.is_finished and is_engine_turn(game):
+        schedule_engine_move(game)
+    
+    return jsonify(response_data), status
+
+def play_move(game, user_id, from_pos, to_pos):
+    """Validate and apply a move for user_id, returning (response_data, status_code)"""
+    if game.is_finished:
+        return {"error": "Game is already finished"}, 400
+    
+    if game.white_player_id != user_id and game.black_player_id != user_id:
+        return {"error": "You are not a participant in this game"}, 403
+    
+    # A move made after the flag fell loses on time
+    now = datetime.utcnow()
+    if settle_flag_fall(game, now):
+        return {"error": "Game has timed out"}, 400
+    
     # Check if it's the user's turn
     user_color = "white" if game.white_player_id == user_id else "black"
     if user_color != game.current_turn:
-        return jsonify({"error": "It's not your turn"}), 400
+        return {"error": "It's not your turn"}, 400
     
     # Load the current board state
     board = json.loads(game.board_state)
     
     # Check if there's a piece at the from position
     if from_pos not in board:
-        return jsonify({"error": "No piece at starting position"}), 400
+        return {"error": "No piece at starting position"}, 400
     
     # Check if the piece belongs to the current player
     piece = board[from_pos]
     if not piece.startswith(user_color):
-        return jsonify({"error": "That's not your piece"}), 400
+        return {"error": "That's not your piece"}, 400
     
-    # Validate the move using chess rules
-    if not is_valid_move(piece, from_pos, to_pos, board):
-        return jsonify({"error": "Invalid move for this piece"}), 400
-    
-    # Create a copy of the board for testing
-    test_board = board.copy()
-    test_board[to_pos] = piece
-    del test_board[from_pos]
-    
-    # Check if the move would put or leave the player's king in check
-    if is_in_check(user_color, test_board):
-        return jsonify({"error": "This move would leave your king in check"}), 400
+    # Validate the move against the cached legal-move set for this position
+    if to_pos not in legal_move_cache.get(game, board).get(from_pos, []):
+        if not is_valid_move(piece, from_pos, to_pos, board):
+            return {"error": "Invalid move for this piece"}, 400
+        # The piece can move there, so the move must expose the king
+        return {"error": "This move would leave your king in check"}, 400
     
     # Move is valid - update the board
-    board[to_pos] = piece
-    del board[from_pos]
+    move_list = get_move_list(game)
+    plies_before = move_list.ply_count or 0
+    premove = db.session.get(Premove, game.id)
+    draw_reason = apply_validated_move(game, move_list, board, piece, from_pos, to_pos, now)
+    ending = game_ending(user_id, game.current_turn, board, draw_reason)
+    
+    # The opponent's premove is the reply to this move: play it in the same transaction,
+    # so both moves are committed as one update of the game
+    premove_data = None
+    if premove is not None:
+        db.session.delete(premove)
+        if ending is None and premove.user_id != user_id and premove.ply == plies_before:
+            premove_data, ending = play_premove(game, move_list, premove, board, now)
+    
+    if ending:
+        # Checkmate, stalemate or an automatic draw ends the game in the move's own transaction,
+        # so a version conflict can only roll back both together
+        result, winner_id = ending
+        finish_game(game, winner_id)
+    
+    # Flush first so the response carries the version of the position it returns
+    db.session.flush()
+    version = game.version
+    your_turn = ending is None and game.current_turn == user_color
+    # Not cached: the version is only real once the commit below succeeds
+    legal_moves = generate_legal_moves(user_color, board) if your_turn else {}
     
-    # Update the game state
-    opponent_color = "black" if user_color == "white" else "white"
-    game.board_state = json.dumps(board)
-    game.current_turn = opponent_color
-    
-    # Since player made a move, update activity timestamp - THIS IS THE KEY POINT
-    # Reset the last_activity timestamp to the current time
-    game.last_activity = datetime.utcnow()
-    print(f"Game {game.id}: Activity timestamp reset due to player move")
-    
-    # Record the move
-    new_move = Move(
-        game_id=game_id,
-        user_id=user_id,
-        from_position=from_pos,
-        to_position=to_pos,
-        piece=piece
-    )
-    
-    db.session.add(new_move)
     # Commit the changes to the database
     db.session.commit()
     
-    # If the game is now in checkmate or stalemate, update the status
-    if is_checkmate(opponent_color, board):
-        # Update game status via handle_game_end function
-        handle_game_end(game_id, user_id, "checkmate")
-        
-        return jsonify({
-            'status': 'success',
-            'board': board,
-            'turn': opponent_color,
-            'is_finished': True,
-            'result': 'checkmate',
-            'winner': user.name
-        })
-        
-    if is_stalemate(opponent_color, board):
-        # Update game status via handle_game_end function
-        handle_game_end(game_id, None, "stalemate")
+    if ending:
+        analysis_pipeline.submit(game.id)
         
-        return jsonify({
+        response_data = {
             'status': 'success',
+            'version': version,
             'board': board,
-            'turn': opponent_color,
+            'turn': game.current_turn,
             'is_finished': True,
-            'result': 'stalemate',
-            'winner': None
-        })
+            'result': result,
+            'winner': display_name(winner_id) if winner_id else None
+        }
+        if premove_data:
+            response_data['premove'] = premove_data
+        return response_data, 200
     
     response_data = {
         "status": "success",
-        "game_id": game_id,
+        "game_id": game.id,
+        "version": version,
         "board": board,
         "turn": game.current_turn,
+        "your_turn": your_turn,
+        "in_check": your_turn and is_in_check(user_color, board),
+        "legal_moves": legal_moves,
         "last_move": {
             "from": from_pos,
             "to": to_pos,
             "piece": piece,
             "player": user_color,
-            "player_name": player_name
+            "player_name": display_name(user_id)
         },
-        "is_finished": game.is_finished
+        "is_finished": game.is_finished,
+        "clock": clock_state(game, now)
     }
+    if premove_data:
+        response_data['premove'] = premove_data
+    
+    return response_data, 200
+
+def apply_validated_move(game, move_list, board, piece, from_pos, to_pos, now):
+    """Play a validated move on board and game without committing; returns the draw reason it caused, if any"""
+    captured = board.get(to_pos)
+    board[to_pos] = piece
+    del board[from_pos]
+    
+    # Update repetition, fifty-move and material tracking
+    draw_reason = game.track_position(piece, from_pos, to_pos, captured, board)
+    
+    # Update the game state
+    game.board_state = json.dumps(board)
+    game.press_clock(now)
+    game.current_turn = "black" if game.current_turn == "white" else "white"
+    game.last_activity = now
+    
+    # Record the move
+    move_list.append(from_pos, to_pos, game.last_activity)
+    return draw_reason
+
+def game_ending(mover_id, next_color, board, draw_reason):
+    """(result, winner_id) if the move just played by mover_id ended the game, else None"""
+    if is_checkmate(next_color, board):
+        return 'checkmate', mover_id
+    if is_stalemate(next_color, board):
+        return 'stalemate', None
+    if draw_reason:
+        # Threefold repetition, fifty-move rule or insufficient material
+        return draw_reason, None
+    return None
+
+def play_premove(game, move_list, premove, board, now):
+    """Play a stored premove if it is still legal; returns (premove data, game ending or None)"""
+    color = game.current_turn
+    from_pos, to_pos = premove.from_position, premove.to_position
+    piece = board.get(from_pos)
+    # Not the cached legal moves: they are keyed by the version, which has not been bumped yet
+    if not piece or not piece.startswith(color) or to_pos not in generate_legal_moves(color, board).get(from_pos, []):
+        return {"from": from_pos, "to": to_pos, "status": "rejected"}, None
+    
+    draw_reason = apply_validated_move(game, move_list, board, piece, from_pos, to_pos, now)
+    premove_data = {
+        "from": from_pos,
+        "to": to_pos,
+        "piece": piece,
+        "player": color,
+        "player_name": display_name(premove.user_id),
+        "status": "played"
+    }
+    return premove_data, game_ending(premove.user_id, game.current_turn, board, draw_reason)
+
+@bp.route('/api/premove/<game_id>', methods=['POST', 'DELETE'])
+def register_premove(game_id):
+    """Register (POST {from, to}) or cancel (DELETE) a premove during the opponent's turn"""
+    if 'user_id' not in session:
+        return jsonify({"error": "You must be logged in to premove"}), 401
+    
+    user_id = session['user_id']
+    game = db.session.get(Game, game_id)
+    if not game:
+        return jsonify({"error": "Game not found"}), 404
+    if game.white_player_id != user_id and game.black_player_id != user_id:
+        return jsonify({"error": "You are not a participant in this game"}), 403
+    
+    if request.method == 'DELETE':
+        Premove.query.filter_by(game_id=game_id, user_id=user_id).delete(synchronize_session=False)
+        db.session.commit()
+        return jsonify({"status": "cancelled"})
     
     if game.is_finished:
-        response_data["result"] = "checkmate" if response_data["result"] == "checkmate" else "stalemate"
+        return jsonify({"error": "Game is already finished"}), 400
     
-    return jsonify(response_data), 200
+    data = request.get_json(silent=True) or {}
+    from_pos, to_pos = data.get('from'), data.get('to')
+    squares = get_all_positions()
+    if from_pos not in squares or to_pos not in squares or from_pos == to_pos:
+        return jsonify({"error": "Invalid premove data. Must include 'from' and 'to' squares"}), 400
+    
+    user_color = "white" if game.white_player_id == user_id else "black"
+    if user_color == game.current_turn:
+        return jsonify({"error": "It's your turn, make the move instead"}), 400
+    piece = json.loads(game.board_state).get(from_pos)
+    if not piece or not piece.startswith(user_color):
+        return jsonify({"error": "That's not your piece"}), 400
+    
+    # Legality is checked when the opponent's move arrives, against the position it creates
+    db.session.merge(Premove(game_id=game_id, user_id=user_id, ply=count_plies(game_id),
+                             from_position=from_pos, to_position=to_pos, created_at=datetime.utcnow()))
+    db.session.commit()
+    return jsonify({"status": "registered", "from": from_pos, "to": to_pos})
 
-@app.route('/forfeit-game/<game_id>', methods=['POST'])
+@bp.route('/forfeit-game/<game_id>', methods=['POST'])
 def forfeit_game(game_id):
     if 'user_id' not in session:
         flash('Please log in to forfeit a game.')
-        return redirect(url_for('login'))
+        return redirect(url_for('chess.login'))
     
     user_id = session['user_id']
     game = Game.query.get(game_id)
     
     if not game:
         flash('Game not found.')
-        return redirect(url_for('home'))
+        return redirect(url_for('chess.home'))
     
     # Check if user is a participant in the game
     if user_id != game.white_player_id and user_id != game.black_player_id:
         flash('You are not a participant in this game.')
-        return redirect(url_for('home'))
+        return redirect(url_for('chess.home'))
     
     # Check if game is already finished
     if game.is_finished:
         flash('This game is already finished.')
-        return redirect(url_for('home'))
+        return redirect(url_for('chess.home'))
     
     # User forfeits, opponent wins
     opponent_id = game.black_player_id if user_id == game.white_player_id else game.white_player_id
@@ -1028,12 +2404,17 @@ def forfeit_game(game_id):
     game.winner_id = opponent_id
     
     # Update statistics via handle_game_end
-    handle_game_end(game_id, opponent_id, "forfeit")
+    try:
+        handle_game_end(game_id, opponent_id, "forfeit")
+    except StaleDataError:
+        db.session.rollback()
+        flash('The game changed before your forfeit was recorded. Please try again.')
+        return redirect(url_for('chess.game_page', game_id=game_id))
     
     flash('You have forfeited the game.')
-    return redirect(url_for('home'))
+    return redirect(url_for('chess.home'))
 
-@app.route('/api/check-session')
+@bp.route('/api/check-session')
 def check_session():
     """API endpoint to check if user's session is still valid"""
     if 'user_id' not in session:
@@ -1041,7 +2422,7 @@ def check_session():
     
     return jsonify({"status": "authenticated"}), 200
 
-@app.route('/api/check-timeout/<game_id>')
+@bp.route('/api/check-timeout/<game_id>')
 def check_timeout(game_id):
     """Check if the current player's turn has timed out"""
     if 'user_id' not in session:
@@ -1056,8 +2437,13 @@ def check_timeout(game_id):
     if game.white_player_id != user_id and game.black_player_id != user_id:
         return jsonify({"error": "You are not a participant in this game"}), 403
     
-    # Check for timeout
-    timed_out = game.check_timeout()
+    # The only write path besides moves and the scheduler: settle an expired clock
+    try:
+        timed_out = settle_flag_fall(game)
+    except StaleDataError:
+        # The game changed meanwhile (a move in time, or the scheduler settled it)
+        db.session.rollback()
+        timed_out = False
     
     # Get user color
     user_color = "white" if game.white_player_id == user_id else "black"
@@ -1071,14 +2457,13 @@ def check_timeout(game_id):
     }
     
     if game.is_finished and game.winner_id:
-        winner = User.query.get(game.winner_id)
-        response["winner"] = winner.name if winner else None
+        response["winner"] = display_name(game.winner_id)
     
     return jsonify(response), 200
 
-@app.route('/api/show-inactivity-status/<game_id>')
+@bp.route('/api/show-inactivity-status/<game_id>')
 def show_inactivity_status(game_id):
-    """Show the current inactivity status of a game (for debugging)"""
+    """Show the clock state of a game (for debugging)"""
     if 'user_id' not in session:
         return jsonify({"error": "Not authenticated"}), 401
     
@@ -1091,27 +2476,14 @@ def show_inactivity_status(game_id):
     if game.white_player_id != user_id and game.black_player_id != user_id:
         return jsonify({"error": "Not your game"}), 403
     
-    # Calculate inactivity time
-    current_time = datetime.utcnow()
-    inactivity_time = None
-    
-    if game.last_activity:
-        time_since_last_activity = current_time - game.last_activity
-        inactivity_time = time_since_last_activity.total_seconds()
-    
-    # Check if the current turn player has been inactive too long
-    will_timeout = False
-    if inactivity_time and inactivity_time > 60:
-        will_timeout = True
-    
+    now = datetime.utcnow()
     return jsonify({
         "game_id": game.id,
         "current_turn": game.current_turn,
-        "last_activity": game.last_activity.strftime('%Y-%m-%d %H:%M:%S') if game.last_activity else None,
-        "inactivity_time_seconds": inactivity_time,
-        "will_timeout": will_timeout,
-        "timeout_threshold": 60,
-        "remaining_seconds": 60 - inactivity_time if inactivity_time else None
+        "turn_started_at": game.turn_started_at.strftime('%Y-%m-%d %H:%M:%S') if game.turn_started_at else None,
+        "flag_deadline": game.flag_deadline.strftime('%Y-%m-%d %H:%M:%S') if game.flag_deadline else None,
+        "clock": clock_state(game, now),
+        "will_timeout": game.has_flagged(now)
     }), 200
 
 # Update to handle_game_end function to update statistics
@@ -1121,8 +2493,20 @@ def handle_game_end(game_id, winner_id=None, result="checkmate"):
     if not game:
         return False
     
+    finish_game(game, winner_id)
+    db.session.commit()
+    analysis_pipeline.submit(game_id)
+    return True
+
+def finish_game(game, winner_id=None):
+    """Mark the game finished and update both players' statistics, without committing"""
+    game_id = game.id
+    game.stop_clock()
     game.is_finished = True
     game.winner_id = winner_id
+    # Claim the finish with the version check, so statistics are only counted by one request
+    db.session.flush()
+    Premove.query.filter_by(game_id=game_id).delete(synchronize_session=False)
     
     # Update player statistics
     white_player = User.query.get(game.white_player_id)
@@ -1141,12 +2525,1450 @@ def handle_game_end(game_id, winner_id=None, result="checkmate"):
             white_player.update_stats('loss')
             black_player.update_stats('win')
     
+    if GameAnalysis.query.get(game_id) is None:
+        db.session.add(GameAnalysis(game_id=game_id))
+
+# Player statistics rebuild
+# User.games_* are maintained incrementally by update_stats; rebuild-stats
+# recomputes them from the games themselves when they drift.
+STATS_CHUNK_SIZE = 1000
+
+def player_results(first_id, last_id):
+    """Count finished games for users with ids in [first_id, last_id]; returns {user_id: (played, won, lost, drawn)}"""
+    sides = [
+        select(Game.white_player_id.label('player_id'), Game.winner_id)
+        .where(Game.white_player_id.between(first_id, last_id), Game.is_finished == True),
+        select(Game.black_player_id.label('player_id'), Game.winner_id)
+        .where(Game.black_player_id.between(first_id, last_id), Game.is_finished == True),
+        select(ArchivedGame.white_player_id.label('player_id'), ArchivedGame.winner_id)
+        .where(ArchivedGame.white_player_id.between(first_id, last_id)),
+        select(ArchivedGame.black_player_id.label('player_id'), ArchivedGame.winner_id)
+        .where(ArchivedGame.black_player_id.between(first_id, last_id)),
+    ]
+    results = union_all(*sides).subquery()
+    rows = db.session.execute(
+        select(results.c.player_id,
+               func.count(),
+               func.sum(case((results.c.winner_id == results.c.player_id, 1), else_=0)),
+               func.sum(case((results.c.winner_id.is_(None), 1), else_=0)))
+        .group_by(results.c.player_id)
+    )
+    return {player_id: (played, won, played - won - drawn, drawn) for player_id, played, won, drawn in rows}
+
+def rebuild_player_stats(first_id, last_id, repair=True):
+    """Compare one chunk of users' counters with their games, fixing drift if repair; returns (checked, drifted, repaired)"""
+    # Counters are read before the games are counted and written back only if still unchanged,
+    # so a game finishing meanwhile skips that user instead of losing its update
+    counters = (User.games_played, User.games_won, User.games_lost, User.games_drawn)
+    users = db.session.execute(
+        select(User.id, User.name, *counters).where(User.id.between(first_id, last_id))
+    ).all()
+    actual = player_results(first_id, last_id)
+    
+    drifted = []
+    repaired = 0
+    for user_id, name, *stored in users:
+        stored = tuple(value or 0 for value in stored)
+        expected = actual.get(user_id, (0, 0, 0, 0))
+        if stored == expected:
+            continue
+        drifted.append((name, stored, expected))
+        if repair:
+            result = db.session.execute(
+                update(User)
+                .where(User.id == user_id,
+                       *[func.coalesce(column, 0) == value for column, value in zip(counters, stored)])
+                .values(dict(zip(('games_played', 'games_won', 'games_lost', 'games_drawn'), expected)))
+                .execution_options(synchronize_session=False)
+            )
+            repaired += result.rowcount
+    # End the transaction per chunk so no lock is held across the whole table
     db.session.commit()
-    return True
+    return len(users), drifted, repaired
+
+@bp.cli.command('rebuild-stats')
+@click.option('--verify', is_flag=True, help='Only report players whose counters disagree with their games.')
+@click.option('--chunk-size', default=STATS_CHUNK_SIZE, show_default=True, help='Users recomputed per transaction.')
+@click.option('--show', default=20, show_default=True, help='Drifted players listed in the report.')
+def rebuild_stats_command(verify, chunk_size, show):
+    """Recompute players' game counters from finished and archived games"""
+    first_id, last_id = db.session.execute(select(func.min(User.id), func.max(User.id))).one()
+    checked = repaired = 0
+    drifted = []
+    started = time.monotonic()
+    
+    if first_id is not None:
+        for chunk_start in range(first_id, last_id + 1, chunk_size):
+            count, chunk_drift, chunk_repaired = rebuild_player_stats(
+                chunk_start, min(chunk_start + chunk_size - 1, last_id), repair=not verify)
+            checked += count
+            drifted += chunk_drift
+            repaired += chunk_repaired
+    
+    for name, stored, actual in drifted[:show]:
+        click.echo(f"{name}: stored played/won/lost/drawn {'/'.join(map(str, stored))}, "
+                   f"games say {'/'.join(map(str, actual))}")
+    if len(drifted) > show:
+        click.echo(f"... and {len(drifted) - show} more")
+    
+    elapsed = time.monotonic() - started
+    summary = f"Checked {checked} players in {elapsed:.1f}s: {len(drifted)} drifted"
+    if verify:
+        click.echo(summary)
+        if drifted:
+            click.get_current_context().exit(1)
+    else:
+        skipped = len(drifted) - repaired
+        click.echo(f"{summary}, {repaired} repaired"
+                   + (f", {skipped} changed during the rebuild (run again to retry)" if skipped else ""))
+
+# Computer opponent
+ENGINE_USER_NAME = 'OnlyChess Engine'
+# level -> (max depth, time budget per move in ms)
+ENGINE_LEVELS = {1: (1, 250), 2: (2, 500), 3: (3, 1000), 4: (4, 2000), 5: (6, 4000)}
+ENGINE_MAX_DEPTH = 8
+ENGINE_MAX_MOVETIME_MS = 10000
+PIECE_VALUES = {'pawn': 100, 'knight': 320, 'bishop': 330, 'rook': 500, 'queen': 900, 'king': 0}
+MATE_SCORE = 100000
+INFINITE_SCORE = 2 * MATE_SCORE
+TT_EXACT, TT_LOWER, TT_UPPER = 0, 1, 2
+
+class SearchTimeout(Exception):
+    """Raised inside the search once the time budget is spent"""
+
+def evaluate_position(board, color):
+    """Static evaluation in centipawns from the point of view of color"""
+    score = 0
+    for pos, piece in board.items():
+        piece_color, piece_type = piece.split('_')
+        col = ord(pos[0]) - ord('a')
+        row = int(pos[1]) - 1
+        # 0 on the edge up to 3 in the four central squares
+        centrality = 3.5 - max(abs(col - 3.5), abs(row - 3.5))
+        
+        value = PIECE_VALUES[piece_type]
+        if piece_type == 'pawn':
+            advance = row - 1 if piece_color == 'white' else 6 - row
+            value += 6 * advance + (8 if 2 <= col <= 5 and advance >= 2 else 0)
+        elif piece_type == 'knight':
+            value += int(10 * centrality)
+        elif piece_type in ('bishop', 'queen'):
+            value += int(4 * centrality)
+        elif piece_type == 'king':
+            value -= int(6 * centrality)
+        
+        score += value if piece_color == color else -value
+    return score
+
+class EngineSearch:
+    """Iterative-deepening alpha-beta search with a transposition table"""
+    def __init__(self, movetime_ms):
+        self.deadline = time.monotonic() + movetime_ms / 1000
+        self.nodes = 0
+        self.table = {}  # position hash -> (depth, score, flag, best move)
+
+    def _tick(self):
+        self.nodes += 1
+        if self.nodes & 255 == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def ordered_moves(self, board, color, tt_move=None):
+        """Legal moves ordered hash move first, then captures by MVV-LVA"""
+        moves = []
+        for from_pos, targets in generate_legal_moves(color, board).items():
+            attacker = board[from_pos].split('_')[1]
+            for to_pos in targets:
+                if (from_pos, to_pos) == tt_move:
+                    order = INFINITE_SCORE
+                elif to_pos in board:
+                    victim = board[to_pos].split('_')[1]
+                    order = MATE_SCORE + 10 * PIECE_VALUES[victim] - PIECE_VALUES[attacker]
+                else:
+                    order = 0
+                moves.append((order, from_pos, to_pos))
+        moves.sort(reverse=True)
+        return moves
+
+    def negamax(self, board, color, depth, alpha, beta, ply, key):
+        self._tick()
+        original_alpha = alpha
+        tt_move = None
+        entry = self.table.get(key)
+        if entry is not None:
+            entry_depth, entry_score, entry_flag, tt_move = entry
+            if ply > 0 and entry_depth >= depth:
+                if entry_flag == TT_EXACT:
+                    return entry_score
+                if entry_flag == TT_LOWER:
+                    alpha = max(alpha, entry_score)
+                elif entry_flag == TT_UPPER:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    return entry_score
+        
+        if depth == 0:
+            return self.quiesce(board, color, alpha, beta)
+        
+        moves = self.ordered_moves(board, color, tt_move)
+        if not moves:
+            # Checkmate (prefer the fastest mate) or stalemate
+            return -MATE_SCORE + ply if is_in_check(color, board) else 0
+        
+        opponent_color = "black" if color == "white" else "white"
+        best_score, best_move = -INFINITE_SCORE, None
+        for _, from_pos, to_pos in moves:
+            piece = board[from_pos]
+            captured = board.get(to_pos)
+            board[to_pos] = piece
+            del board[from_pos]
+            child_key = update_position_hash(key, piece, from_pos, to_pos, captured)
+            score = -self.negamax(board, opponent_color, depth - 1, -beta, -alpha, ply + 1, child_key)
+            board[from_pos] = piece
+            if captured:
+                board[to_pos] = captured
+            else:
+                del board[to_pos]
+            
+            if score > best_score:
+                best_score, best_move = score, (from_pos, to_pos)
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+        
+        if best_score <= original_alpha:
+            flag = TT_UPPER
+        elif best_score >= beta:
+            flag = TT_LOWER
+        else:
+            flag = TT_EXACT
+        self.table[key] = (depth, best_score, flag, best_move)
+        return best_score
+
+    def quiesce(self, board, color, alpha, beta):
+        """Search captures only, so the evaluation isn't taken mid-exchange"""
+        self._tick()
+        stand_pat = evaluate_position(board, color)
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        
+        captures = []
+        for from_pos, piece in board.items():
+            if piece.startswith(color):
+                for to_pos in candidate_squares(piece, from_pos, board):
+                    if to_pos in board:
+                        order = 10 * PIECE_VALUES[board[to_pos].split('_')[1]] - PIECE_VALUES[piece.split('_')[1]]
+                        captures.append((order, from_pos, to_pos))
+        captures.sort(reverse=True)
+        
+        opponent_color = "black" if color == "white" else "white"
+        for _, from_pos, to_pos in captures:
+            piece = board[from_pos]
+            captured = board[to_pos]
+            board[to_pos] = piece
+            del board[from_pos]
+            if is_in_check(color, board):
+                score = None
+            else:
+                score = -self.quiesce(board, opponent_color, -beta, -alpha)
+            board[from_pos] = piece
+            board[to_pos] = captured
+            
+            if score is None:
+                continue
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+def search_best_move(board, color, max_depth, movetime_ms):
+    """Pick a move for color by iterative deepening within a hard time budget; None if there is no legal move"""
+    search = EngineSearch(movetime_ms)
+    started = time.monotonic()
+    root_moves = search.ordered_moves(board, color)
+    if not root_moves:
+        return None  # Checkmate or stalemate: negamax scores it without storing a root move
+    root_key = position_hash(board, color)
+    best_move, score, depth_reached = None, 0, 0
+    
+    for depth in range(1, max_depth + 1):
+        try:
+            depth_score = search.negamax(board.copy(), color, depth, -INFINITE_SCORE, INFINITE_SCORE, 0, root_key)
+        except SearchTimeout:
+            break
+        entry = search.table.get(root_key)
+        if entry is None or entry[3] is None:
+            break
+        best_move, score, depth_reached = entry[3], depth_score, depth
+        if abs(score) >= MATE_SCORE - ENGINE_MAX_DEPTH:
+            break  # A forced mate was found
+    
+    if best_move is None:
+        # Not even depth 1 finished in time: take the best-ordered legal move
+        best_move = root_moves[0][1:]
+    
+    elapsed = time.monotonic() - started
+    return {
+        "from": best_move[0],
+        "to": best_move[1],
+        "score": score,
+        "depth": depth_reached,
+        "nodes": search.nodes,
+        "nps": int(search.nodes / max(elapsed, 1e-6)),
+        "time_ms": int(elapsed * 1000)
+    }
+
+_engine_pending = set()
+_engine_lock = threading.Lock()
+_engine_executor = None
+
+def get_engine_executor():
+    """Return the process pool the engine searches run in"""
+    global _engine_executor
+    with _engine_lock:
+        if _engine_executor is None:
+            _engine_executor = ProcessPoolExecutor(max_workers=current_app.config['ENGINE_WORKERS'])
+        return _engine_executor
+
+def get_engine_user():
+    """Return the User account the computer opponent plays as, creating it if needed"""
+    engine = User.query.filter_by(is_engine=True).first()
+    if engine is None:
+        engine = User(name=ENGINE_USER_NAME,
+                      password=generate_password_hash(os.urandom(16).hex(), method='pbkdf2:sha256'),
+                      is_engine=True)
+        db.session.add(engine)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created it first
+            db.session.rollback()
+            engine = User.query.filter_by(is_engine=True).first()
+    return engine
+
+def engine_player_id(game):
+    """Return the engine's user id if it plays in this game, otherwise None"""
+    if game.engine_depth is None and game.engine_movetime_ms is None:
+        return None
+    engine = get_engine_user()
+    return engine.id if engine.id in (game.white_player_id, game.black_player_id) else None
+
+def is_engine_turn(game):
+    """Check whether the computer opponent is the side to move"""
+    engine_id = engine_player_id(game)
+    if engine_id is None:
+        return False
+    to_move_id = game.white_player_id if game.current_turn == 'white' else game.black_player_id
+    return to_move_id == engine_id
+
+def schedule_engine_move(game):
+    """Start the engine's search in the process pool; the move is applied when it finishes"""
+    with _engine_lock:
+        if game.id in _engine_pending:
+            return
+        _engine_pending.add(game.id)
+    
+    default_depth, default_movetime = ENGINE_LEVELS[current_app.config['ENGINE_DEFAULT_LEVEL']]
+    future = get_engine_executor().submit(
+        search_best_move,
+        json.loads(game.board_state),
+        game.current_turn,
+        game.engine_depth or default_depth,
+        game.engine_movetime_ms or default_movetime
+    )
+    future.add_done_callback(functools.partial(_apply_engine_move, current_app._get_current_object(),
+                                               game.id, game.version))
+
+def _apply_engine_move(app, game_id, version, future):
+    """Play the move found by a finished engine search"""
+    with _engine_lock:
+        _engine_pending.discard(game_id)
+    
+    try:
+        result = future.result()
+    except Exception as e:
+        print(f"Game {game_id}: engine search failed: {e}")
+        return
+    if result is None:
+        return
+    
+    with app.app_context():
+        game = Game.query.get(game_id)
+        # Skip if the game ended or changed while the engine was thinking
+        if not game or game.is_finished or game.version != version:
+            return
+        
+        # Saved with the move, so a sync served by any worker process can report it
+        game.engine_search = json.dumps({key: result[key] for key in ('depth', 'nodes', 'nps', 'time_ms', 'score')})
+        print(f"Game {game_id}: engine played {result['from']}{result['to']} "
+              f"(depth {result['depth']}, {result['nodes']} nodes, {result['nps']} nodes/s, {result['time_ms']} ms)")
+        
+        engine_id = game.white_player_id if game.current_turn == 'white' else game.black_player_id
+        try:
+            response_data, status = play_move(game, engine_id, result['from'], result['to'])
+        except StaleDataError:
+            db.session.rollback()
+            print(f"Game {game_id}: game changed during the engine move, discarding it")
+            return
+        if status != 200:
+            print(f"Game {game_id}: engine move rejected: {response_data.get('error')}")
+        elif not game.is_finished and is_engine_turn(game):
+            # The player's premove was played in reply: think again
+            schedule_engine_move(game)
+
+@bp.route('/play-engine', methods=['POST'])
+def play_engine():
+    """Start a game against the computer opponent"""
+    if 'user_id' not in session:
+        flash('You must be logged in to play')
+        return redirect(url_for('chess.login'))
+    
+    user_id = session['user_id']
+    
+    # Check if user is already in a game
+    active_game = Game.query.filter(
+        (Game.white_player_id == user_id) | (Game.black_player_id == user_id),
+        Game.is_finished == False
+    ).first()
+    
+    if active_game:
+        return redirect(url_for('chess.game_page', game_id=active_game.id))
+    
+    # Strength comes from a level preset, optionally overridden by explicit depth/time limits
+    level = request.form.get('level', current_app.config['ENGINE_DEFAULT_LEVEL'], type=int)
+    depth, movetime_ms = ENGINE_LEVELS.get(level, ENGINE_LEVELS[current_app.config['ENGINE_DEFAULT_LEVEL']])
+    depth = min(max(request.form.get('depth', depth, type=int), 1), ENGINE_MAX_DEPTH)
+    movetime_ms = min(max(request.form.get('movetime_ms', movetime_ms, type=int), 100), ENGINE_MAX_MOVETIME_MS)
+    
+    color = request.form.get('color', 'white')
+    if color not in ('white', 'black'):
+        color = random.choice(['white', 'black'])
+    
+    engine = get_engine_user()
+    new_game = Game(
+        white_player_id=user_id if color == 'white' else engine.id,
+        black_player_id=engine.id if color == 'white' else user_id,
+        engine_depth=depth,
+        engine_movetime_ms=movetime_ms
+    )
+    new_game.start_clock(current_app.config['CLOCK_BASE_SECONDS'], current_app.config['CLOCK_INCREMENT_SECONDS'])
+    
+    # Leave the matchmaking queue if the player was waiting in it
+    Queue.query.filter_by(user_id=user_id).delete()
+    db.session.add(new_game)
+    db.session.commit()
+    
+    if is_engine_turn(new_game):
+        schedule_engine_move(new_game)
+    
+    return redirect(url_for('chess.game_page', game_id=new_game.id))
+
+# Post-game analysis
+# Centipawn loss thresholds for move annotations
+ANALYSIS_LABELS = [(300, 'blunder'), (100, 'mistake'), (50, 'inaccuracy')]
+ANALYSIS_EVAL_CAP = 1000  # Clamp mate scores so one mate line doesn't swamp the averages
+
+def _lower_analysis_priority():
+    """Pool initializer: run analysis below the priority of the web workers"""
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+def evaluate_for_analysis(task):
+    """Evaluate one position in an analysis worker; returns (centipawns for the side to move, best move)"""
+    board, color, depth, movetime_ms = task
+    if not generate_legal_moves(color, board):
+        # Game over on the board: mated or stalemated
+        return (-MATE_SCORE if is_in_check(color, board) else 0), None
+    result = search_best_move(board, color, depth, movetime_ms)
+    return result['score'], result['from'] + result['to']
+
+def win_percent(score):
+    """Expected score in percent for a centipawn evaluation"""
+    return 50 + 50 * (2 / (1 + math.exp(-0.00368208 * score)) - 1)
+
+def analysis_positions(move_list):
+    """Replay a game; returns its moves and the (board, side to move) before each ply, plus the final one"""
+    board = initial_board_state()
+    color = 'white'
+    moves, positions = [], [(dict(board), color)]
+    for move in move_list.iter_moves():
+        piece = board.pop(move.from_pos, None)
+        board[move.to_pos] = piece
+        color = 'black' if color == 'white' else 'white'
+        moves.append(move.from_pos + move.to_pos)
+        positions.append((dict(board), color))
+    return moves, positions
+
+def annotate_game(moves, evaluations):
+    """Turn per-position evaluations into move annotations and accuracy per side"""
+    annotations = []
+    accuracy = {'white': [], 'black': []}
+    for ply, move in enumerate(moves):
+        color = 'white' if ply % 2 == 0 else 'black'
+        best_score, best_move = evaluations[ply]
+        before = max(-ANALYSIS_EVAL_CAP, min(ANALYSIS_EVAL_CAP, best_score))
+        after = max(-ANALYSIS_EVAL_CAP, min(ANALYSIS_EVAL_CAP, -evaluations[ply + 1][0]))
+        loss = max(0, before - after)
+        
+        label = next((name for threshold, name in ANALYSIS_LABELS if loss >= threshold), None)
+        drop = max(0, win_percent(before) - win_percent(after))
+        accuracy[color].append(max(0.0, min(100.0, 103.1668 * math.exp(-0.04354 * drop) - 3.1669)))
+        annotations.append({
+            "ply": ply + 1,
+            "move": move,
+            "eval": after if color == 'white' else -after,
+            "best_move": best_move,
+            "cp_loss": loss,
+            "label": label
+        })
+    
+    def average(values):
+        return round(sum(values) / len(values), 1) if values else None
+    return annotations, average(accuracy['white']), average(accuracy['black'])
+
+def load_analysis_move_list(game_id):
+    """Return the MoveList of a finished game, hot or archived"""
+    game = Game.query.get(game_id)
+    if game is not None:
+        return MoveList.query.get(game_id) or build_move_list(game_id, game.created_at)
+    entry = ArchivedGame.query.get(game_id)
+    if entry is not None:
+        return archived_move_list(read_archived_game(entry))
+    return None
+
+class AnalysisPipeline:
+    """Background analysis of finished games in a low-priority process pool fed by a bounded queue"""
+    
+    def __init__(self):
+        self.app = None
+        self._queue = None
+        self._queued = set()  # ids queued or in progress, so the refill doesn't duplicate them
+        self._pool = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.games_analyzed = 0
+        self.games_failed = 0
+        self.positions_evaluated = 0
+        self.deferred = 0
+        self.busy_seconds = 0.0
+    
+    def start(self, app):
+        """Start the worker pool and the dispatcher thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.app = app
+            self._queue = queue.Queue(maxsize=app.config['ANALYSIS_QUEUE_SIZE'])
+            self._pool = self._create_pool(app.config['ANALYSIS_WORKERS'])
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        print(f"Started game analysis with {app.config['ANALYSIS_WORKERS']} worker processes")
+    
+    def _create_pool(self, workers):
+        return multiprocessing.Pool(processes=workers, initializer=_lower_analysis_priority)
+    
+    def submit(self, game_id):
+        """Queue a finished game without blocking; returns False if it was deferred"""
+        if self._queue is None:
+            return False
+        with self._lock:
+            if game_id in self._queued:
+                return True
+            try:
+                self._queue.put_nowait(game_id)
+            except queue.Full:
+                self.deferred += 1
+                return False
+            self._queued.add(game_id)
+        return True
+    
+    def analyse(self, game_id, pool):
+        """Analyse one game; returns the values to write to its GameAnalysis row"""
+        started = time.monotonic()
+        try:
+            move_list = load_analysis_move_list(game_id)
+            if move_list is None:
+                raise LookupError("game not found")
+            moves, positions = analysis_positions(move_list)
+            tasks = [(board, color, current_app.config['ANALYSIS_DEPTH'], current_app.config['ANALYSIS_MOVETIME_MS'])
+                     for board, color in positions]
+            chunksize = max(1, len(tasks) // (4 * current_app.config['ANALYSIS_WORKERS']))
+            evaluations = pool.map(evaluate_for_analysis, tasks, chunksize=chunksize)
+            annotations, white_accuracy, black_accuracy = annotate_game(moves, evaluations)
+        except Exception as e:
+            print(f"Game {game_id}: analysis failed: {e}")
+            self.games_failed += 1
+            return {"game_id": game_id, "status": 'failed', "analyzed_at": datetime.utcnow()}
+        finally:
+            self.busy_seconds += time.monotonic() - started
+        
+        self.games_analyzed += 1
+        self.positions_evaluated += len(positions)
+        return {
+            "game_id": game_id,
+            "status": 'done',
+            "white_accuracy": white_accuracy,
+            "black_accuracy": black_accuracy,
+            "annotations": json.dumps(annotations),
+            "positions": len(positions),
+            "analyzed_at": datetime.utcnow()
+        }
+    
+    def write_results(self, results):
+        """Write a batch of results in one transaction"""
+        db.session.execute(update(GameAnalysis), results)
+        db.session.commit()
+        with self._lock:
+            self._queued.difference_update(result["game_id"] for result in results)
+    
+    def pending_game_ids(self, limit):
+        """Oldest games still waiting for analysis"""
+        rows = (db.session.query(GameAnalysis.game_id)
+                .filter(GameAnalysis.status == 'pending')
+                .order_by(GameAnalysis.created_at)
+                .limit(limit)
+                .all())
+        return [game_id for game_id, in rows]
+    
+    def refill(self):
+        """Queue deferred games (and ones left over from a restart) while there is room"""
+        free = self._queue.maxsize - self._queue.qsize()
+        if free <= 0:
+            return
+        with self._lock:
+            skip = len(self._queued)
+        for game_id in self.pending_game_ids(free + skip):
+            if not self.submit(game_id):
+                break
+    
+    def _run(self):
+        batch = []
+        last_flush = time.monotonic()
+        while True:
+            try:
+                game_id = self._queue.get(timeout=self.app.config['ANALYSIS_FLUSH_SECONDS'])
+            except queue.Empty:
+                game_id = None
+            
+            try:
+                with self.app.app_context():
+                    if game_id is not None:
+                        batch.append(self.analyse(game_id, self._pool))
+                    
+                    now = time.monotonic()
+                    if batch and (game_id is None or len(batch) >= current_app.config['ANALYSIS_BATCH_SIZE']
+                                  or now - last_flush >= current_app.config['ANALYSIS_FLUSH_SECONDS']):
+                        self.write_results(batch)
+                        stats = self.stats()
+                        print(f"Analysis: wrote {len(batch)} games ({stats['games_per_second']} games/s, "
+                              f"{stats['positions_per_second']} positions/s, queue {stats['queue_depth']})")
+                        batch, last_flush = [], now
+                    
+                    if game_id is None:
+                        self.refill()
+            except Exception as e:
+                print(f"Error in analysis pipeline: {e}")
+                batch = []
+                with self._lock:
+                    self._queued.clear()  # Anything unwritten is still 'pending' and gets re-queued
+                time.sleep(30)
+    
+    def stats(self):
+        """Throughput and queue metrics"""
+        busy = max(self.busy_seconds, 1e-6)
+        return {
+            "running": self._thread is not None,
+            "workers": current_app.config['ANALYSIS_WORKERS'],
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "queue_capacity": current_app.config['ANALYSIS_QUEUE_SIZE'],
+            "games_analyzed": self.games_analyzed,
+            "games_failed": self.games_failed,
+            "positions_evaluated": self.positions_evaluated,
+            "deferred": self.deferred,
+            "games_per_second": round(self.games_analyzed / busy, 2),
+            "positions_per_second": round(self.positions_evaluated / busy, 1)
+        }
+
+analysis_pipeline = AnalysisPipeline()
+
+@bp.route('/api/analysis/<game_id>', methods=['GET'])
+def game_analysis(game_id):
+    """Return the post-game analysis of a finished game"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    analysis = GameAnalysis.query.get(game_id)
+    if not analysis:
+        return jsonify({"error": "No analysis for this game"}), 404
+    
+    response = {"game_id": game_id, "status": analysis.status}
+    if analysis.status == 'done':
+        response.update({
+            "white_accuracy": analysis.white_accuracy,
+            "black_accuracy": analysis.black_accuracy,
+            "annotations": json.loads(analysis.annotations),
+            "analyzed_at": analysis.analyzed_at.isoformat()
+        })
+    return jsonify(response)
+
+@bp.route('/api/analysis-stats', methods=['GET'])
+def analysis_stats():
+    """Return throughput metrics of the analysis pipeline"""
+    if 'user_id' not in session:
+        return jsonify({"error": "Not authenticated"}), 401
+    
+    stats = analysis_pipeline.stats()
+    stats["pending"] = GameAnalysis.query.filter_by(status='pending').count()
+    return jsonify(stats)
+
+@bp.cli.command('analyze-games')
+@click.option('--limit', type=int, default=None, help='Stop after this many games.')
+@click.option('--workers', type=int, default=None, help='Defaults to ANALYSIS_WORKERS.')
+def analyze_games_command(limit, workers):
+    """Analyse pending finished games in the foreground"""
+    if workers:
+        current_app.config['ANALYSIS_WORKERS'] = workers
+    pipeline = AnalysisPipeline()
+    batch_size = current_app.config['ANALYSIS_BATCH_SIZE']
+    total = 0
+    started = time.monotonic()
+    with pipeline._create_pool(current_app.config['ANALYSIS_WORKERS']) as pool:
+        while limit is None or total < limit:
+            size = batch_size if limit is None else min(batch_size, limit - total)
+            game_ids = pipeline.pending_game_ids(size)
+            if not game_ids:
+                break
+            pipeline.write_results([pipeline.analyse(game_id, pool) for game_id in game_ids])
+            total += len(game_ids)
+            elapsed = max(time.monotonic() - started, 1e-6)
+            click.echo(f"Analysed {total} games ({total / elapsed:.2f} games/s, "
+                       f"{pipeline.positions_evaluated / elapsed:.1f} positions/s)")
+    click.echo(f"Done: analysed {pipeline.games_analyzed} games, {pipeline.games_failed} failed")
+
+# Cold game archive
+ARCHIVE_RECORD_HEADER = struct.Struct('<II')  # payload length, crc32
+
+class GameArchive:
+    """Append-only, zlib-compressed segment files holding finished games, read through mmaps"""
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:06d}.dat")
+
+    def _current_segment(self):
+        """Return the segment new records go to, rolling over when it is full"""
+        segments = sorted(int(name[8:14]) for name in os.listdir(self.directory)
+                          if name.startswith('segment-') and name.endswith('.dat'))
+        if not segments:
+            return 1
+        if os.path.getsize(self.segment_path(segments[-1])) >= self.segment_bytes:
+            return segments[-1] + 1
+        return segments[-1]
+
+    def append(self, records):
+        """Append records (dicts) and return their (segment, offset, length) locations"""
+        os.makedirs(self.directory, exist_ok=True)
+        segment = self._current_segment()
+        locations = []
+        with open(self.segment_path(segment), 'ab') as f:
+            offset = f.tell()
+            for record in records:
+                payload = zlib.compress(json.dumps(record, separators=(',', ':')).encode(), 6)
+                f.write(ARCHIVE_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+                f.write(payload)
+                length = ARCHIVE_RECORD_HEADER.size + len(payload)
+                locations.append((segment, offset, length))
+                offset += length
+            f.flush()
+            os.fsync(f.fileno())
+        return locations
+
+    def _map(self, segment, end):
+        """Return an mmap of the segment covering at least `end` bytes"""
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            if mapped is not None:
+                mapped.close()
+            with open(self.segment_path(segment), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mapped
+        return mapped
+
+    def read(self, segment, offset, length):
+        """Read and decode the record stored at the given location"""
+        with self._lock:
+            data = self._map(segment, offset + length)[offset:offset + length]
+        payload_length, checksum = ARCHIVE_RECORD_HEADER.unpack_from(data)
+        payload = data[ARCHIVE_RECORD_HEADER.size:ARCHIVE_RECORD_HEADER.size + payload_length]
+        if zlib.crc32(payload) != checksum:
+            raise ValueError(f"Corrupt archive record in segment {segment} at offset {offset}")
+        return json.loads(zlib.decompress(payload))
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps.clear()
+
+_game_archives = {}
+
+def get_game_archive():
+    """Return the GameArchive for the configured archive directory"""
+    directory = current_app.config['ARCHIVE_DIR']
+    archive = _game_archives.get(directory)
+    if archive is None:
+        archive = _game_archives[directory] = GameArchive(directory, current_app.config['ARCHIVE_SEGMENT_BYTES'])
+    return archive
+
+def read_archived_game(entry):
+    """Load the archived record for an ArchivedGame index entry"""
+    return get_game_archive().read(entry.segment, entry.offset, entry.length)
+
+def archived_move_list(record):
+    """Rebuild a transient MoveList from an archived record"""
+    return MoveList(game_id=record["id"],
+                    moves=base64.b64decode(record["moves"]),
+                    timings=base64.b64decode(record["timings"]),
+                    ply_count=record["ply_count"],
+                    started_at=datetime.fromisoformat(record["started_at"]),
+                    checkpoints=base64.b64decode(record.get("checkpoints", "")))
+
+def archive_game_record(game, move_list):
+    """Build the archive record for a finished game"""
+    return {
+        "id": game.id,
+        "white_player_id": game.white_player_id,
+        "black_player_id": game.black_player_id,
+        "winner_id": game.winner_id,
+        "timeout_user_id": game.timeout_user_id,
+        "board_state": game.board_state,
+        "created_at": game.created_at.isoformat(),
+        "finished_at": game.updated_at.isoformat(),
+        "started_at": move_list.started_at.isoformat(),
+        "ply_count": move_list.ply_count,
+        "moves": base64.b64encode(move_list.moves or b'').decode(),
+        "timings": base64.b64encode(move_list.timings or b'').decode(),
+        "checkpoints": base64.b64encode(move_list.checkpoints or b'').decode(),
+    }
+
+def archive_finished_games(older_than, batch_size=500):
+    """Move one batch of finished games older than `older_than` into the archive; returns the count"""
+    games = (Game.query
+             .filter(Game.is_finished == True, Game.updated_at < older_than)
+             .order_by(Game.updated_at)
+             .limit(batch_size)
+             .all())
+    if not games:
+        return 0
+    
+    game_ids = [game.id for game in games]
+    move_lists = {move_list.game_id: move_list
+                  for move_list in MoveList.query.filter(MoveList.game_id.in_(game_ids))}
+    records = []
+    for game in games:
+        move_list = move_lists.get(game.id) or build_move_list(game.id, game.created_at)
+        records.append(archive_game_record(game, move_list))
+    
+    # The segment write is fsynced before the hot rows go, so a crash at worst leaves an unreferenced record
+    locations = get_game_archive().append(records)
+    for game, (segment, offset, length) in zip(games, locations):
+        db.session.add(ArchivedGame(
+            game_id=game.id,
+            white_player_id=game.white_player_id,
+            black_player_id=game.black_player_id,
+            winner_id=game.winner_id,
+            timeout_user_id=game.timeout_user_id,
+            created_at=game.created_at,
+            finished_at=game.updated_at,
+            segment=segment,
+            offset=offset,
+            length=length
+        ))
+    
+    db.session.query(Move).filter(Move.game_id.in_(game_ids)).delete(synchronize_session=False)
+    db.session.query(MoveList).filter(MoveList.game_id.in_(game_ids)).delete(synchronize_session=False)
+    db.session.query(Game).filter(Game.id.in_(game_ids)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(games)
+
+@bp.cli.command('archive-games')
+@click.option('--older-than-days', type=int, default=None, help='Defaults to ARCHIVE_AFTER_DAYS.')
+@click.option('--batch-size', default=500, show_default=True, help='Games archived per transaction.')
+def archive_games_command(older_than_days, batch_size):
+    """Move old finished games out of the hot tables into the cold archive"""
+    days = older_than_days if older_than_days is not None else current_app.config['ARCHIVE_AFTER_DAYS']
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    total = 0
+    while True:
+        archived = archive_finished_games(cutoff, batch_size)
+        if not archived:
+            break
+        total += archived
+        click.echo(f"Archived {total} games...")
+    click.echo(f"Done: archived {total} games finished before {cutoff:%Y-%m-%d %H:%M}")
+
+# Game export (PGN / NDJSON)
+PGN_PIECE_LETTERS = {'king': 'K', 'queen': 'Q', 'rook': 'R', 'bishop': 'B', 'knight': 'N', 'pawn': ''}
+EXPORT_BATCH_SIZE = 1000
+
+def is_legal_move(color, piece, from_pos, to_pos, board):
+    """Check a move against the piece rules and make sure it does not leave the king in check"""
+    if not is_valid_move(piece, from_pos, to_pos, board):
+        return False
+    test_board = board.copy()
+    test_board[to_pos] = piece
+    del test_board[from_pos]
+    return not is_in_check(color, test_board)
+
+def move_to_san(piece, from_pos, to_pos, board):
+    """Return the SAN for a move, where board is the position before the move"""
+    color, piece_type = piece.split('_')
+    is_capture = to_pos in board
+    
+    if piece_type == 'pawn':
+        san = f"{from_pos[0]}x{to_pos}" if is_capture else to_pos
+    else:
+        # Disambiguate when another piece of the same kind can reach the square
+        rivals = [pos for pos, other in board.items()
+                  if other == piece and pos != from_pos and is_legal_move(color, piece, pos, to_pos, board)]
+        disambiguation = ''
+        if rivals:
+            if all(pos[0] != from_pos[0] for pos in rivals):
+                disambiguation = from_pos[0]
+            elif all(pos[1] != from_pos[1] for pos in rivals):
+                disambiguation = from_pos[1]
+            else:
+                disambiguation = from_pos
+        san = PGN_PIECE_LETTERS[piece_type] + disambiguation + ('x' if is_capture else '') + to_pos
+    
+    after = board.copy()
+    after[to_pos] = piece
+    del after[from_pos]
+    opponent_color = "black" if color == "white" else "white"
+    if is_checkmate(opponent_color, after):
+        san += '#'
+    elif is_in_check(opponent_color, after):
+        san += '+'
+    return san
+
+def game_result_tag(winner_id, white_player_id):
+    """PGN result string for a finished game"""
+    if winner_id is None:
+        return '1/2-1/2'
+    return '1-0' if winner_id == white_player_id else '0-1'
+
+def _export_filters(created_at, game_id, white_player_id, black_player_id, user_id, since, until, cursor):
+    """Build the shared filter clauses for the hot and archived export queries"""
+    clauses = []
+    if user_id is not None:
+        clauses.append((white_player_id == user_id) | (black_player_id == user_id))
+    if since is not None:
+        clauses.append(created_at >= since)
+    if until is not None:
+        clauses.append(created_at < until)
+    if cursor is not None:
+        cursor_at, cursor_id = decode_keyset_cursor(cursor)
+        clauses.append(or_(created_at > cursor_at, and_(created_at == cursor_at, game_id > cursor_id)))
+    return clauses
+
+def _iter_hot_export_rows(**filters):
+    """Yield export rows for finished games still in the hot tables"""
+    white = aliased(User)
+    black = aliased(User)
+    stmt = (
+        select(Game.created_at, Game.id, Game.updated_at, Game.white_player_id, Game.black_player_id,
+               Game.winner_id, Game.timeout_user_id, white.name, black.name,
+               MoveList.moves, MoveList.timings, MoveList.started_at)
+        .join(white, white.id == Game.white_player_id)
+        .join(black, black.id == Game.black_player_id)
+        .outerjoin(MoveList, MoveList.game_id == Game.id)
+        .where(Game.is_finished == True,
+               *_export_filters(Game.created_at, Game.id, Game.white_player_id, Game.black_player_id, **filters))
+        .order_by(Game.created_at, Game.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE, stream_results=True)
+    )
+    rows = db.session.execute(stmt)
+    for (created_at, game_id, finished_at, white_id, black_id, winner_id, timeout_user_id,
+         white_name, black_name, packed_moves, packed_timings, started_at) in rows:
+        if packed_moves is None:
+            # Game has not been migrated off legacy Move rows yet
+            move_list = build_move_list(game_id, created_at)
+        else:
+            move_list = MoveList(game_id=game_id, moves=packed_moves, timings=packed_timings, started_at=started_at)
+        yield (created_at, game_id, finished_at, white_id, black_id, winner_id, timeout_user_id,
+               white_name, black_name, move_list)
+    rows.close()
+
+def _iter_archived_export_rows(**filters):
+    """Yield export rows for games in the cold archive"""
+    white = aliased(User)
+    black = aliased(User)
+    stmt = (
+        select(ArchivedGame, white.name, black.name)
+        .join(white, white.id == ArchivedGame.white_player_id)
+        .join(black, black.id == ArchivedGame.black_player_id)
+        .where(*_export_filters(ArchivedGame.created_at, ArchivedGame.game_id,
+                                ArchivedGame.white_player_id, ArchivedGame.black_player_id, **filters))
+        .order_by(ArchivedGame.created_at, ArchivedGame.game_id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE, stream_results=True)
+    )
+    rows = db.session.execute(stmt)
+    for entry, white_name, black_name in rows:
+        move_list = archived_move_list(read_archived_game(entry))
+        yield (entry.created_at, entry.game_id, entry.finished_at, entry.white_player_id, entry.black_player_id,
+               entry.winner_id, entry.timeout_user_id, white_name, black_name, move_list)
+        db.session.expunge(entry)
+    rows.close()
+
+def iter_exported_games(user_id=None, since=None, until=None, cursor=None):
+    """Yield finished games with their moves one at a time, hot and archived merged in (created_at, id) order"""
+    filters = dict(user_id=user_id, since=since, until=until, cursor=cursor)
+    merged = heapq.merge(_iter_hot_export_rows(**filters), _iter_archived_export_rows(**filters),
+                         key=lambda row: (row[0], row[1]))
+    for (created_at, game_id, finished_at, white_id, black_id, winner_id, timeout_user_id,
+         white_name, black_name, move_list) in merged:
+        # Replay the moves to recover which piece was played
+        moves = []
+        board = initial_board_state()
+        for move in move_list.iter_moves():
+            piece = board.pop(move.from_pos, None)
+            board[move.to_pos] = piece
+            moves.append({"from": move.from_pos, "to": move.to_pos, "piece": piece, "played_at": move.played_at})
+        
+        yield {
+            "id": game_id,
+            "created_at": created_at,
+            "finished_at": finished_at,
+            "white_id": white_id,
+            "black_id": black_id,
+            "winner_id": winner_id,
+            "timeout_user_id": timeout_user_id,
+            "white": white_name,
+            "black": black_name,
+            "result": game_result_tag(winner_id, white_id),
+            "moves": moves,
+            "cursor": encode_keyset_cursor(created_at, game_id)
+        }
+
+def format_game_ndjson(game):
+    """Serialize an exported game as one NDJSON line"""
+    record = dict(game)
+    record["created_at"] = game["created_at"].isoformat() if game["created_at"] else None
+    record["finished_at"] = game["finished_at"].isoformat() if game["finished_at"] else None
+    record["moves"] = [
+        {**move, "played_at": move["played_at"].isoformat() if move["played_at"] else None}
+        for move in game["moves"]
+    ]
+    return json.dumps(record) + "\n"
+
+def format_game_pgn(game):
+    """Serialize an exported game as a PGN record"""
+    headers = [
+        ("Event", "OnlyChess game"),
+        ("Site", "OnlyChess"),
+        ("Date", game["created_at"].strftime('%Y.%m.%d') if game["created_at"] else "????.??.??"),
+        ("Round", "-"),
+        ("White", game["white"]),
+        ("Black", game["black"]),
+        ("Result", game["result"]),
+        ("GameId", game["id"]),
+        ("ExportCursor", game["cursor"]),
+    ]
+    if game["timeout_user_id"] is not None:
+        headers.append(("Termination", "time forfeit"))
+    
+    tokens = []
+    board = initial_board_state()
+    for ply, move in enumerate(game["moves"]):
+        if ply % 2 == 0:
+            tokens.append(f"{ply // 2 + 1}.")
+        tokens.append(move_to_san(move["piece"], move["from"], move["to"], board))
+        board[move["to"]] = move["piece"]
+        board.pop(move["from"], None)
+    tokens.append(game["result"])
+    
+    # Wrap movetext at 80 columns as recommended by the PGN standard
+    lines, line = [], ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 80:
+            lines.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    lines.append(line)
+    
+    header_text = "".join(f'[{name} "{str(value).replace(chr(34), chr(39))}"]\n' for name, value in headers)
+    return header_text + "\n" + "\n".join(lines) + "\n\n"
+
+EXPORT_FORMATS = {
+    'pgn': (format_game_pgn, 'application/x-chess-pgn'),
+    'ndjson': (format_game_ndjson, 'application/x-ndjson'),
+}
+
+def parse_export_date(value):
+    """Parse an ISO date/datetime query value (raises ValueError)"""
+    return datetime.fromisoformat(value) if value else None
+
+@bp.route('/api/export/games')
+def export_games():
+    """Stream finished games as PGN or NDJSON"""
+    if 'user_id' not in session:
+        return jsonify({"error": "You must be logged in to export games"}), 401
+    
+    export_format = request.args.get('format', 'pgn')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": "Format must be 'pgn' or 'ndjson'"}), 400
+    formatter, mimetype = EXPORT_FORMATS[export_format]
+    
+    try:
+        user_id = request.args.get('user_id', type=int)
+        since = parse_export_date(request.args.get('since'))
+        until = parse_export_date(request.args.get('until'))
+        cursor = request.args.get('cursor')
+        if cursor:
+            decode_keyset_cursor(cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    def generate():
+        for game in iter_exported_games(user_id=user_id, since=since, until=until, cursor=cursor):
+            yield formatter(game)
+    
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+@bp.cli.command('export-games')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='pgn')
+@click.option('--user', 'user_name', default=None, help='Only export games played by this user.')
+@click.option('--since', default=None, help='Only games created on or after this ISO date.')
+@click.option('--until', default=None, help='Only games created before this ISO date.')
+@click.option('--cursor', default=None, help='Resume after the game with this export cursor.')
+@click.option('--output', type=click.File('w'), default='-')
+def export_games_command(export_format, user_name, since, until, cursor, output):
+    """Stream finished games to a file as PGN or NDJSON"""
+    user_id = None
+    if user_name:
+        user = User.query.filter_by(name=user_name).first()
+        if not user:
+            raise click.ClickException(f"Unknown user: {user_name}")
+        user_id = user.id
+    
+    try:
+        since, until = parse_export_date(since), parse_export_date(until)
+        if cursor:
+            decode_keyset_cursor(cursor)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    formatter = EXPORT_FORMATS[export_format][0]
+    exported = 0
+    for game in iter_exported_games(user_id=user_id, since=since, until=until, cursor=cursor):
+        output.write(formatter(game))
+        exported += 1
+    click.echo(f"Exported {exported} games", err=True)
+
+# Game import (PGN)
+PGN_TAG_RE = re.compile(r'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]\s*$')
+PGN_SAN_RE = re.compile(r'^([KQRBN])?([a-h])?([1-8])?(x)?([a-h][1-8])(=[QRBN])?[+#]?$')
+PGN_RESULTS = {'1-0': 'white', '0-1': 'black', '1/2-1/2': None}
+PGN_PIECE_TYPES = {letter: piece_type for piece_type, letter in PGN_PIECE_LETTERS.items() if letter}
+IMPORT_BATCH_SIZE = 1000
+IMPORTED_PLAYER_PASSWORD = '!'  # Not a valid hash, so accounts created by an import cannot log in
+
+class PGNImportError(ValueError):
+    """A game in a PGN file that cannot be imported"""
+
+def iter_pgn_games(lines):
+    """Split a stream of PGN lines into the text of individual games"""
+    chunk, in_movetext = [], False
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith('[') and in_movetext:
+            # A tag after movetext starts the next game
+            yield ''.join(chunk)
+            chunk, in_movetext = [], False
+        if stripped and not stripped.startswith(('[', '%')):
+            in_movetext = True
+        chunk.append(line)
+    if any(line.strip() for line in chunk):
+        yield ''.join(chunk)
+
+def pgn_movetext_tokens(movetext):
+    """Strip comments, variations, NAGs and move numbers, leaving SAN tokens and the result"""
+    movetext = re.sub(r'\{[^}]*\}|;[^\n]*|\$\d+', ' ', movetext)
+    while True:
+        stripped = re.sub(r'\([^()]*\)', ' ', movetext)
+        if stripped == movetext:
+            break
+        movetext = stripped
+    if '(' in movetext or ')' in movetext:
+        raise PGNImportError("unbalanced variation")
+    
+    for token in movetext.split():
+        token = re.sub(r'^\d+\.+', '', token).rstrip('!?')
+        if token:
+            yield token
+
+def resolve_san(san, color, board):
+    """Find the (from, to) move a SAN token refers to, checking it against the rules engine"""
+    if san.startswith(('O-O', '0-0')):
+        raise PGNImportError(f"castling is not supported: {san}")
+    match = PGN_SAN_RE.match(san)
+    if not match:
+        raise PGNImportError(f"malformed move: {san}")
+    letter, from_file, from_rank, _, to_pos, promotion = match.groups()
+    if promotion:
+        raise PGNImportError(f"promotion is not supported: {san}")
+    
+    piece = f"{color}_{PGN_PIECE_TYPES[letter] if letter else 'pawn'}"
+    candidates = [from_pos for from_pos, targets in generate_legal_moves(color, board).items()
+                  if board[from_pos] == piece and to_pos in targets
+                  and (from_file is None or from_pos[0] == from_file)
+                  and (from_rank is None or from_pos[1] == from_rank)]
+    if not candidates:
+        raise PGNImportError(f"illegal move: {san}")
+    if len(candidates) > 1:
+        raise PGNImportError(f"ambiguous move: {san}")
+    return candidates[0], to_pos
+
+def parse_pgn_game(pgn_text):
+    """Validate one PGN game by replaying it in an import worker; returns its rows or {"error": reason}"""
+    try:
+        headers, movetext = {}, []
+        for line in pgn_text.splitlines():
+            match = PGN_TAG_RE.match(line.strip())
+            if match:
+                headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+            elif not line.startswith('%'):
+                movetext.append(line)
+        
+        white, black = headers.get('White', '').strip(), headers.get('Black', '').strip()
+        if not white or not black or white == '?' or black == '?':
+            raise PGNImportError("missing player names")
+        if white == black:
+            raise PGNImportError("a player cannot play against themselves")
+        if len(white) > 80 or len(black) > 80:
+            raise PGNImportError("player name too long")
+        if ENGINE_USER_NAME in (white, black):
+            # Reserved for the computer opponent's account, as in register
+            raise PGNImportError(f"player name {ENGINE_USER_NAME!r} is reserved")
+        
+        board = initial_board_state()
+        color = 'white'
+        codes = []
+        checkpoints = bytearray()
+        result = headers.get('Result')
+        for token in pgn_movetext_tokens('\n'.join(movetext)):
+            if token in PGN_RESULTS or token == '*':
+                result = token
+                break
+            from_pos, to_pos = resolve_san(token, color, board)
+            board[to_pos] = board.pop(from_pos)
+            codes.append(encode_move(from_pos, to_pos))
+            if len(codes) % CHECKPOINT_INTERVAL == 0:
+                checkpoints += pack_position(board)
+            color = 'black' if color == 'white' else 'white'
+        
+        if result not in PGN_RESULTS:
+            raise PGNImportError("game is unfinished")
+        if is_checkmate(color, board) and PGN_RESULTS[result] == color:
+            raise PGNImportError(f"result {result} contradicts the final checkmate")
+        
+        played_on = None
+        date = headers.get('UTCDate') or headers.get('Date') or ''
+        if re.match(r'^\d{4}\.\d{2}\.\d{2}$', date):
+            played_on = datetime.strptime(date, '%Y.%m.%d').isoformat()
+    except PGNImportError as e:
+        return {"error": str(e)}
+    except Exception as e:
+        return {"error": f"unreadable game: {e}"}
+    
+    return {
+        "white": white,
+        "black": black,
+        "winner": PGN_RESULTS[result],
+        "board": board,
+        "turn": color,
+        "moves": struct.pack(f'<{len(codes)}H', *codes),
+        "checkpoints": bytes(checkpoints),
+        "ply_count": len(codes),
+        "played_on": played_on
+    }
+
+def resolve_import_players(names, create_players):
+    """Map player names to user ids, creating accounts for unknown names if allowed"""
+    user_ids = dict(db.session.query(User.name, User.id).filter(User.name.in_(names)))
+    missing = [name for name in names if name not in user_ids]
+    if missing and create_players:
+        db.session.execute(insert(User), [
+            {"name": name, "password": IMPORTED_PLAYER_PASSWORD, "games_played": 0, "games_won": 0,
+             "games_lost": 0, "games_drawn": 0, "created_at": datetime.utcnow(), "is_engine": False}
+            for name in missing
+        ])
+        user_ids.update(db.session.query(User.name, User.id).filter(User.name.in_(missing)))
+    return user_ids
+
+def import_pgn_batch(parsed_games, create_players=True):
+    """Insert a batch of parsed games in one transaction; returns [(index, reason)] for rejected games"""
+    rejected = []
+    names = {name for game in parsed_games if "error" not in game for name in (game["white"], game["black"])}
+    user_ids = resolve_import_players(sorted(names), create_players)
+    
+    game_rows, move_list_rows = [], []
+    stats = {}
+    for index, game in enumerate(parsed_games):
+        if "error" in game:
+            continue
+        if game["white"] not in user_ids or game["black"] not in user_ids:
+            rejected.append((index, "unknown player"))
+            continue
+        
+        white_id, black_id = user_ids[game["white"]], user_ids[game["black"]]
+        winner_id = {'white': white_id, 'black': black_id}.get(game["winner"])
+        played_at = datetime.fromisoformat(game["played_on"]) if game["played_on"] else datetime.utcnow()
+        game_id = str(uuid.uuid4())
+        game_rows.append({
+            "id": game_id,
+            "white_player_id": white_id,
+            "black_player_id": black_id,
+            "board_state": json.dumps(game["board"]),
+            "current_turn": game["turn"],
+            "is_finished": True,
+            "winner_id": winner_id,
+            "created_at": played_at,
+            "updated_at": played_at,
+            "last_activity": played_at,
+            "version": 1,
+            "halfmove_clock": 0
+        })
+        move_list_rows.append({
+            "game_id": game_id,
+            "moves": game["moves"],
+            "timings": bytes(game["ply_count"]),  # Move times are unknown: zero deltas
+            "ply_count": game["ply_count"],
+            "started_at": played_at,
+            "last_move_at": played_at,
+            "checkpoints": game["checkpoints"]
+        })
+        
+        for user_id in (white_id, black_id):
+            played, won, lost, drawn = stats.get(user_id, (0, 0, 0, 0))
+            stats[user_id] = (played + 1,
+                              won + (winner_id == user_id),
+                              lost + (winner_id is not None and winner_id != user_id),
+                              drawn + (winner_id is None))
+    
+    if game_rows:
+        db.session.execute(insert(Game), game_rows)
+        db.session.execute(insert(MoveList), move_list_rows)
+        db.session.execute(
+            text("UPDATE user SET games_played = games_played + :played, games_won = games_won + :won, "
+                 "games_lost = games_lost + :lost, games_drawn = games_drawn + :drawn WHERE id = :id"),
+            [{"id": user_id, "played": played, "won": won, "lost": lost, "drawn": drawn}
+             for user_id, (played, won, lost, drawn) in stats.items()]
+        )
+    db.session.commit()
+    return rejected
+
+@bp.cli.command('import-pgn')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True, help='Games inserted per transaction.')
+@click.option('--workers', type=int, default=None, help='Validation processes, defaults to one per CPU.')
+@click.option('--create-players/--no-create-players', default=True, show_default=True,
+              help='Create accounts for unknown player names.')
+@click.option('--rejects', type=click.File('w'), default=None, help='Write rejected games to this file.')
+def import_pgn_command(paths, batch_size, workers, create_players, rejects):
+    """Import finished games from PGN files"""
+    workers = workers or os.cpu_count() or 1
+    imported = rejected_total = 0
+    started = time.monotonic()
+    
+    with multiprocessing.Pool(processes=workers) as pool:
+        for path in paths:
+            with open(path, encoding='utf-8', errors='replace') as pgn_file:
+                games = iter_pgn_games(pgn_file)
+                number = 0
+                while True:
+                    # Read one batch at a time so memory stays bounded for any file size
+                    texts = list(itertools.islice(games, batch_size))
+                    if not texts:
+                        break
+                    parsed = pool.map(parse_pgn_game, texts, chunksize=max(1, len(texts) // (4 * workers)))
+                    
+                    rejected = [(index, game["error"]) for index, game in enumerate(parsed) if "error" in game]
+                    rejected += import_pgn_batch(parsed, create_players)
+                    for index, reason in sorted(rejected):
+                        click.echo(f"{path}: game {number + index + 1} rejected: {reason}", err=True)
+                        if rejects:
+                            rejects.write(texts[index].rstrip() + "\n\n")
+                    
+                    number += len(texts)
+                    imported += len(texts) - len(rejected)
+                    rejected_total += len(rejected)
+                    elapsed = max(time.monotonic() - started, 1e-6)
+                    click.echo(f"Imported {imported} games, rejected {rejected_total} ({imported / elapsed:.1f} games/s)")
+    
+    elapsed = max(time.monotonic() - started, 1e-6)
+    click.echo(f"Done: imported {imported} games, rejected {rejected_total} in {elapsed:.1f}s "
+               f"({imported / elapsed:.1f} games/s)")
+
+@bp.cli.command('migrate-move-lists')
+@click.option('--batch-size', default=500, show_default=True, help='Games converted per transaction.')
+@click.option('--purge', is_flag=True, help='Delete the legacy Move rows once a game is converted.')
+def migrate_move_lists_command(batch_size, purge):
+    """Convert legacy per-ply Move rows into packed MoveList rows"""
+    converted = 0
+    while True:
+        pending = (db.session.query(Game.id, Game.created_at)
+                   .filter(db.session.query(Move.id).filter(Move.game_id == Game.id).exists())
+                   .filter(~db.session.query(MoveList.game_id).filter(MoveList.game_id == Game.id).exists())
+                   .limit(batch_size)
+                   .all())
+        if not pending:
+            break
+        
+        for game_id, created_at in pending:
+            db.session.add(build_move_list(game_id, created_at or datetime.utcnow()))
+        if purge:
+            db.session.query(Move).filter(Move.game_id.in_([game_id for game_id, _ in pending])).delete(synchronize_session=False)
+        db.session.commit()
+        converted += len(pending)
+        click.echo(f"Converted {converted} games...")
+    
+    if purge:
+        # Games that already had a MoveList may still carry legacy rows
+        db.session.query(Move).filter(Move.game_id.in_(db.session.query(MoveList.game_id))).delete(synchronize_session=False)
+        db.session.commit()
+    click.echo(f"Done: converted {converted} games")
+
+# Background workers
+
+def start_background_workers(app):
+    """Start the flag-fall scheduler, the queue sweeper and the analysis pipeline"""
+    threading.Thread(target=check_for_timeouts, args=(app,), daemon=True).start()
+    threading.Thread(target=sweep_queue, args=(app,), daemon=True).start()
+    analysis_pipeline.start(app)
+
+
+@bp.cli.command('run-workers')
+def run_workers_command():
+    """Run the background workers in the foreground"""
+    start_background_workers(current_app._get_current_object())
+    click.echo("Background workers running; press Ctrl+C to stop")
+    while True:
+        time.sleep(3600)
+
 
 if __name__ == '__main__':
-    # Start the background task in a separate thread
-    timeout_thread = threading.Thread(target=check_for_timeouts, daemon=True)
-    timeout_thread.start()
+    app = create_app()
+    with app.app_context():
+        upgrade_database()
+    
+    start_background_workers(app)
     
     app.run(debug=True, port=5000, host='0.0.0.0')
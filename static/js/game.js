@@ -0,0 +1,628 @@
+document.addEventListener('DOMContentLoaded', function() {
+    // Per-page values rendered by the server
+    const gameElement = document.getElementById('chess-game');
+    const playerName = gameElement.dataset.playerName;
+    const homeUrl = gameElement.dataset.homeUrl;
+    const loginUrl = gameElement.dataset.loginUrl;
+    
+    const gameIdSpan = document.getElementById('game-id');
+    const playerColorSpan = document.getElementById('player-color');
+    const opponentNameSpan = document.getElementById('opponent-name');
+    const currentTurnSpan = document.getElementById('current-turn');
+    const chessboard = document.getElementById('chessboard');
+    const selectedPieceSpan = document.getElementById('selected-piece');
+    const makeMoveBtn = document.getElementById('make-move-btn');
+    const gameStatus = document.getElementById('game-status');
+    const clockDisplay = document.getElementById('clock-display');
+    const clockSpans = {
+        white: document.getElementById('white-clock'),
+        black: document.getElementById('black-clock')
+    };
+
+    let currentGameId = gameIdSpan.textContent;
+    let playerColor = playerColorSpan.textContent;
+    let currentBoard = null;
+    let selectedSquare = null;
+    let targetSquare = null;
+    let clockTimer = null;
+    let clock = null; // Last clock state from the server
+    let clockSyncedAt = 0; // When it was received, by the local clock
+    let syncTimer = null;
+    let syncGeneration = 0; // Responses from superseded polls are ignored
+    let boardVersion = null; // Version of the board we are showing
+    let timeoutCheckSent = false;
+    let legalMoves = null; // Server-computed legal moves for the side to move
+    let premoveFrom = null; // First square picked for a premove
+    let premove = null; // Premove registered with the server, played as our reply to the opponent's move
+
+    // Chess piece symbols
+    const pieceSymbols = {
+        'white_pawn': '♙',
+        'white_rook': '♖',
+        'white_knight': '♘',
+        'white_bishop': '♗',
+        'white_queen': '♕',
+        'white_king': '♔',
+        'black_pawn': '♟',
+        'black_rook': '♜',
+        'black_knight': '♞',
+        'black_bishop': '♝',
+        'black_queen': '♛',
+        'black_king': '♚'
+    };
+
+    // Initialize the chessboard (8x8 grid)
+    function initializeBoard() {
+        chessboard.innerHTML = '';
+        const container = document.getElementById('chessboard-container');
+
+        // Clear any existing coordinates
+        document.querySelectorAll('.coordinate').forEach(el => el.remove());
+
+        // Determine if we need to flip the board (for black player)
+        const isBlackPlayer = playerColor === 'black';
+
+        // Create the chess board grid
+        // For white player: row 8 at top, row 1 at bottom
+        // For black player: row 1 at top, row 8 at bottom
+        const rowOrder = isBlackPlayer ? [1, 2, 3, 4, 5, 6, 7, 8] : [8, 7, 6, 5, 4, 3, 2, 1];
+        const colOrder = isBlackPlayer ? ['h', 'g', 'f', 'e', 'd', 'c', 'b', 'a'] : ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'];
+
+        // Add column coordinates (a-h)
+        for (let i = 0; i < 8; i++) {
+            // Top row
+            const topCoord = document.createElement('div');
+            topCoord.className = 'coordinate';
+            topCoord.textContent = colOrder[i];
+            topCoord.style.gridColumn = (i + 2).toString();
+            topCoord.style.gridRow = '1';
+            container.appendChild(topCoord);
+
+            // Bottom row
+            const bottomCoord = document.createElement('div');
+            bottomCoord.className = 'coordinate';
+            bottomCoord.textContent = colOrder[i];
+            bottomCoord.style.gridColumn = (i + 2).toString();
+            bottomCoord.style.gridRow = '10';
+            container.appendChild(bottomCoord);
+        }
+
+        // Add row coordinates (1-8)
+        for (let i = 0; i < 8; i++) {
+            // Left column
+            const leftCoord = document.createElement('div');
+            leftCoord.className = 'coordinate';
+            leftCoord.textContent = rowOrder[i].toString();
+            leftCoord.style.gridColumn = '1';
+            leftCoord.style.gridRow = (i + 2).toString();
+            container.appendChild(leftCoord);
+
+            // Right column
+            const rightCoord = document.createElement('div');
+            rightCoord.className = 'coordinate';
+            rightCoord.textContent = rowOrder[i].toString();
+            rightCoord.style.gridColumn = '10';
+            rightCoord.style.gridRow = (i + 2).toString();
+            container.appendChild(rightCoord);
+        }
+
+        // Build the board with the right orientation
+        for (let rowIndex = 0; rowIndex < 8; rowIndex++) {
+            for (let colIndex = 0; colIndex < 8; colIndex++) {
+                const row = rowOrder[rowIndex];
+                const col = colOrder[colIndex];
+
+                // Calculate color (alternating pattern)
+                const squareColor = (rowIndex + colIndex) % 2 === 0 ? 'light' : 'dark';
+
+                // Create square
+                const square = document.createElement('div');
+                const position = col + row; // Standard chess notation
+
+                square.className = `chess-square ${squareColor}`;
+                square.dataset.position = position;
+                square.addEventListener('click', handleSquareClick);
+
+                chessboard.appendChild(square);
+            }
+        }
+    }
+
+    // Update the board based on the current state
+    function updateBoard(boardState) {
+        currentBoard = boardState;
+
+        // Reset all squares
+        document.querySelectorAll('.chess-square').forEach(square => {
+            square.textContent = '';
+            square.classList.remove('selected', 'move-option', 'white-piece', 'black-piece', 'valid-move-square', 'valid-capture-square');
+            square.removeAttribute('data-piece');
+            square.style.color = '';
+            square.style.textShadow = '';
+        });
+
+        // Place pieces
+        for (const [position, piece] of Object.entries(boardState)) {
+            const squareElement = document.querySelector(`.chess-square[data-position="${position}"]`);
+            if (squareElement) {
+                squareElement.textContent = pieceSymbols[piece] || piece;
+                squareElement.setAttribute('data-piece', piece);
+
+                // Add proper styling for piece color
+                if (piece.startsWith('white')) {
+                    squareElement.classList.add('white-piece');
+                    // Additional direct style for better compatibility
+                    squareElement.style.color = 'white';
+                    squareElement.style.textShadow = '0px 0px 1px black, 0px 0px 1px black, 0px 0px 1px black';
+                } else if (piece.startsWith('black')) {
+                    squareElement.classList.add('black-piece');
+                    // Additional direct style for better compatibility
+                    squareElement.style.color = 'black';
+                    squareElement.style.textShadow = '0px 0px 1px white, 0px 0px 1px white, 0px 0px 1px white';
+                }
+            }
+        }
+
+        // Reset selections
+        selectedSquare = null;
+        selectedPieceSpan.textContent = 'None';
+    }
+
+    // Handle square click
+    function handleSquareClick(event) {
+        const clickedSquare = event.currentTarget;
+        const position = clickedSquare.dataset.position;
+
+        const piece = currentBoard[position];
+        const currentTurn = currentTurnSpan.textContent.toLowerCase();
+
+        // During the opponent's turn, clicks set up a premove instead
+        if (playerColor !== currentTurn) {
+            handlePremoveClick(clickedSquare, position, piece);
+            return;
+        }
+
+        // First click - selecting a piece
+        if (!selectedSquare) {
+            // Clear previous valid move highlights
+            clearValidMoveHighlights();
+
+            // Only allow selecting own pieces on first click
+            if (piece && piece.startsWith(playerColor)) {
+                selectedSquare = position;
+                clickedSquare.classList.add('selected');
+                selectedPieceSpan.textContent = `${pieceSymbols[piece]} at ${position}`;
+
+                // Highlight valid moves
+                highlightValidMoves(piece, position);
+            }
+        } 
+        // Second click
+        else {
+            // Clicking on the same piece - deselect it
+            if (selectedSquare === position) {
+                selectedSquare = null;
+                clickedSquare.classList.remove('selected');
+                selectedPieceSpan.textContent = 'None';
+                clearValidMoveHighlights();
+                return;
+            }
+
+            // Check if this is a valid move
+            const isValidMove = clickedSquare.classList.contains('valid-move-square') || 
+                               clickedSquare.classList.contains('valid-capture-square');
+
+            if (isValidMove) {
+                // Make the move directly
+                makeMove(selectedSquare, position);
+            } else {
+                // If clicking on another of your pieces, select that piece instead
+                if (piece && piece.startsWith(playerColor)) {
+                    // Deselect previous piece
+                    document.querySelector(`.chess-square[data-position="${selectedSquare}"]`).classList.remove('selected');
+
+                    // Select new piece
+                    selectedSquare = position;
+                    clickedSquare.classList.add('selected');
+                    selectedPieceSpan.textContent = `${pieceSymbols[piece]} at ${position}`;
+
+                    // Clear previous highlights and show new valid moves
+                    clearValidMoveHighlights();
+                    highlightValidMoves(piece, position);
+                }
+                // Clicking on an invalid destination does nothing
+            }
+        }
+    }
+
+    // Function to make a move
+    function makeMove(fromSquare, toSquare) {
+        const moveData = {
+            from: fromSquare,
+            to: toSquare,
+            name: playerName
+        };
+
+        // Visual feedback during move processing
+        gameStatus.textContent = 'Processing move...';
+        gameStatus.style.backgroundColor = '#e2e3e5';
+        gameStatus.style.display = 'block';
+
+        // Disable further interactions
+        document.querySelectorAll('.chess-square').forEach(square => {
+            square.style.pointerEvents = 'none';
+        });
+
+        fetch(`/api/make-move/${currentGameId}`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(moveData)
+        })
+        .then(response => response.json())
+        .then(data => {
+            // Re-enable interactions
+            document.querySelectorAll('.chess-square').forEach(square => {
+                square.style.pointerEvents = 'auto';
+            });
+
+            if (data.status === 'success') {
+                // Adopt the new version, so the next sync doesn't resend this position
+                boardVersion = data.version;
+                legalMoves = data.your_turn ? data.legal_moves : null;
+                updateBoard(data.board);
+                currentTurnSpan.textContent = data.turn;
+
+                // Handle game end conditions
+                if (data.is_finished) {
+                    handleGameEnd(data);
+                } else {
+                    if (data.your_turn) {
+                        // The opponent's premove was played in reply
+                        gameStatus.textContent = data.in_check ? 'Your turn! Your king is in check!' : 'Your turn!';
+                        gameStatus.style.backgroundColor = data.in_check ? '#f8d7da' : '#d4edda';
+                    } else {
+                        gameStatus.textContent = 'Waiting for opponent\'s move...';
+                        gameStatus.style.backgroundColor = '#fff3cd';
+                    }
+                    gameStatus.style.display = 'block';
+                    setClock(data.clock);
+
+                    // Start polling for the reply now rather than on the old schedule
+                    clearTimeout(syncTimer);
+                    syncGame();
+                }
+            } else {
+                gameStatus.textContent = data.error || 'Error making move.';
+                gameStatus.style.backgroundColor = '#f8d7da';
+                gameStatus.style.display = 'block';
+
+                // Reset selection on error
+                selectedSquare = null;
+                selectedPieceSpan.textContent = 'None';
+                clearValidMoveHighlights();
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            gameStatus.textContent = 'Error making move.';
+            gameStatus.style.backgroundColor = '#f8d7da';
+            gameStatus.style.display = 'block';
+
+            // Re-enable interactions on error
+            document.querySelectorAll('.chess-square').forEach(square => {
+                square.style.pointerEvents = 'auto';
+            });
+
+            // Reset selection on error
+            selectedSquare = null;
+            selectedPieceSpan.textContent = 'None';
+            clearValidMoveHighlights();
+        });
+    }
+
+    // Premoves: pick a piece and a target while the opponent is thinking; the
+    // server validates and plays the move the moment the opponent's move arrives
+    function handlePremoveClick(square, position, piece) {
+        if (premove || position === premoveFrom) {
+            // Clicking again cancels the premove
+            cancelPremove();
+            return;
+        }
+        if (!premoveFrom) {
+            if (piece && piece.startsWith(playerColor)) {
+                premoveFrom = position;
+                square.classList.add('premove-square');
+            }
+            return;
+        }
+        registerPremove(premoveFrom, position);
+    }
+
+    function registerPremove(fromSquare, toSquare) {
+        fetch(`/api/premove/${currentGameId}`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ from: fromSquare, to: toSquare })
+        })
+        .then(response => response.json())
+        .then(data => {
+            clearPremove();
+            if (data.status === 'registered') {
+                premove = { from: data.from, to: data.to };
+                [data.from, data.to].forEach(position => {
+                    document.querySelector(`.chess-square[data-position="${position}"]`).classList.add('premove-square');
+                });
+                gameStatus.textContent = `Premove ${data.from} → ${data.to} is set. Click the board to cancel it.`;
+                gameStatus.style.backgroundColor = '#e2e3e5';
+            } else {
+                gameStatus.textContent = data.error || 'Could not set the premove.';
+                gameStatus.style.backgroundColor = '#f8d7da';
+            }
+            gameStatus.style.display = 'block';
+        })
+        .catch(error => {
+            console.error('Error setting premove:', error);
+            clearPremove();
+        });
+    }
+
+    function cancelPremove() {
+        if (premove) {
+            fetch(`/api/premove/${currentGameId}`, { method: 'DELETE' }).catch(error => {
+                console.error('Error cancelling premove:', error);
+            });
+            gameStatus.textContent = 'Waiting for opponent\'s move...';
+            gameStatus.style.backgroundColor = '#fff3cd';
+        }
+        clearPremove();
+    }
+
+    function clearPremove() {
+        premoveFrom = null;
+        premove = null;
+        document.querySelectorAll('.premove-square').forEach(square => {
+            square.classList.remove('premove-square');
+        });
+    }
+
+    // Clear valid move highlights
+    function clearValidMoveHighlights() {
+        document.querySelectorAll('.valid-move-square, .valid-capture-square').forEach(square => {
+            square.classList.remove('valid-move-square', 'valid-capture-square');
+        });
+    }
+
+    // Highlight valid moves for a piece using the server's legal-move set
+    function highlightValidMoves(piece, position) {
+        const targets = (legalMoves && legalMoves[position]) || [];
+
+        targets.forEach(targetPos => {
+            const square = document.querySelector(`.chess-square[data-position="${targetPos}"]`);
+            if (!square) return;
+
+            // If target has an opponent's piece, it's a capture
+            if (currentBoard[targetPos] !== undefined) {
+                square.classList.add('valid-capture-square');
+            } else {
+                square.classList.add('valid-move-square');
+            }
+        });
+    }
+
+    // Automatic draw results reported by the server
+    const drawReasons = {
+        'threefold_repetition': 'threefold repetition',
+        'fifty_move_rule': 'the fifty-move rule',
+        'insufficient_material': 'insufficient material'
+    };
+
+    // Handle end game scenarios
+    function handleGameEnd(data) {
+        stopClock();
+
+        // Create game over banner if it doesn't exist
+        let gameOverBanner = document.querySelector('.game-over-banner');
+        if (!gameOverBanner) {
+            gameOverBanner = document.createElement('div');
+            gameOverBanner.className = 'game-over-banner';
+            document.getElementById('game-info').appendChild(gameOverBanner);
+        }
+
+        // Set appropriate message based on game result
+        let resultMessage = '';
+        if (data.result === 'checkmate') {
+            resultMessage = `Game Over! Checkmate! ${data.winner} wins!`;
+            gameOverBanner.style.backgroundColor = '#f0ad4e';
+        } else if (data.result === 'stalemate') {
+            resultMessage = 'Game Over! Stalemate! The game is a draw.';
+            gameOverBanner.style.backgroundColor = '#5bc0de';
+        } else if (drawReasons[data.result]) {
+            resultMessage = `Game Over! Draw by ${drawReasons[data.result]}.`;
+            gameOverBanner.style.backgroundColor = '#5bc0de';
+        }
+
+        gameOverBanner.innerHTML = `<p>${resultMessage}</p>`;
+
+        // Update status display
+        gameStatus.textContent = 'Game finished! Redirecting to home page...';
+        gameStatus.style.backgroundColor = '#d4edda';
+        gameStatus.style.display = 'block';
+
+        // Redirect to home page after a short delay
+        setTimeout(() => {
+            window.location.href = homeUrl;
+        }, 3000);
+    }
+
+    function formatClock(seconds) {
+        const total = Math.max(0, Math.ceil(seconds));
+        return `${Math.floor(total / 60)}:${String(total % 60).padStart(2, '0')}`;
+    }
+
+    // Remaining time of a side right now: the running clock counts down locally between syncs
+    function clockRemaining(color) {
+        const elapsed = clock.running === color ? (Date.now() - clockSyncedAt) / 1000 : 0;
+        return Math.max(0, clock[color] - elapsed);
+    }
+
+    function renderClock() {
+        ['white', 'black'].forEach(color => {
+            const remaining = clockRemaining(color);
+            clockSpans[color].textContent = formatClock(remaining);
+            clockSpans[color].style.color = clock.running === color && remaining <= 10 ? 'red' : '';
+            clockSpans[color].style.fontWeight = clock.running === color ? 'bold' : '';
+        });
+
+        // The flag fell: ask the server to settle it once
+        if (clock.running && clockRemaining(clock.running) <= 0 && !timeoutCheckSent) {
+            timeoutCheckSent = true;
+            fetch(`/api/check-timeout/${currentGameId}`).catch(error => {
+                console.error('Error checking timeout:', error);
+            });
+        }
+    }
+
+    function setClock(state) {
+        if (!state) return;
+        clock = state;
+        clockSyncedAt = Date.now();
+        if (clock.running && clock[clock.running] > 0) {
+            timeoutCheckSent = false; // Time left on the server: allow another check later
+        }
+        clockDisplay.style.display = 'block';
+        renderClock();
+        if (!clockTimer) {
+            clockTimer = setInterval(renderClock, 250);
+        }
+    }
+
+    function stopClock() {
+        if (clockTimer) {
+            clearInterval(clockTimer);
+            clockTimer = null;
+        }
+        if (clock) {
+            clock.running = null;
+            renderClock();
+        }
+    }
+
+    // Show the game over banner and send the player home
+    function showGameOver(data) {
+        let resultMessage = 'Game Over! The game ended in a draw.';
+        if (data.winner) {
+            if (data.timeout_info) {
+                resultMessage = `Game Over! ${data.winner} won because ${data.timeout_info}!`;
+            } else {
+                resultMessage = `Game Over! ${data.winner} won the game!`;
+            }
+        }
+
+        // Create or update game over banner
+        let gameOverBanner = document.querySelector('.game-over-banner');
+        if (!gameOverBanner) {
+            gameOverBanner = document.createElement('div');
+            gameOverBanner.className = 'game-over-banner';
+            document.getElementById('game-info').appendChild(gameOverBanner);
+        }
+        gameOverBanner.innerHTML = `<p>${resultMessage}</p>`;
+
+        // Update status
+        gameStatus.textContent = 'Game finished! Redirecting to home page...';
+        gameStatus.style.backgroundColor = data.timed_out ? '#f8d7da' : '#d4edda';
+        gameStatus.style.display = 'block';
+
+        setTimeout(() => {
+            window.location.href = homeUrl;
+        }, 3000);
+    }
+
+    // Single poll that keeps board, turn, clock and session state in sync
+    function syncGame() {
+        const query = boardVersion === null ? '' : `?since=${boardVersion}`;
+        const generation = ++syncGeneration;
+
+        fetch(`/api/game-sync/${currentGameId}${query}`)
+        .then(response => {
+            if (generation !== syncGeneration) return null;
+            if (response.status === 401) {
+                // User is not authenticated anymore, redirect to login
+                window.location.href = loginUrl;
+                return null;
+            }
+            if (response.status === 429) {
+                // Polling too fast: wait as long as the server asks
+                const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 5;
+                syncTimer = setTimeout(syncGame, retryAfter * 1000);
+                return null;
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (!data) return; // Skip if no data (user was redirected)
+
+            if (data.error) {
+                gameStatus.textContent = data.error;
+                gameStatus.style.backgroundColor = '#f8d7da';
+                gameStatus.style.display = 'block';
+                return;
+            }
+
+            // The board is only included when it changed
+            if (data.board) {
+                // Our premove stays until the server has played or rejected it
+                const premoveResolved = premove !== null && !data.pending_premove;
+                if (premoveResolved || data.your_turn || data.is_finished) {
+                    clearPremove();
+                }
+                boardVersion = data.version;
+                legalMoves = data.your_turn ? data.legal_moves : null;
+                updateBoard(data.board);
+                currentTurnSpan.textContent = data.turn;
+                clearValidMoveHighlights();
+
+                if (data.your_turn) {
+                    gameStatus.textContent = data.in_check ? 'Your turn! Your king is in check!' : 'Your turn!';
+                    if (premoveResolved) {
+                        gameStatus.textContent += ' Your premove was no longer legal.';
+                    }
+                    gameStatus.style.backgroundColor = data.in_check ? '#f8d7da' : '#d4edda';
+                } else if (!data.is_finished) {
+                    gameStatus.textContent = premoveResolved ? 'Your premove was played. Waiting for opponent\'s move...'
+                                                             : 'Waiting for opponent\'s move...';
+                    gameStatus.style.backgroundColor = '#fff3cd';
+                }
+                gameStatus.style.display = 'block';
+            }
+
+            setClock(data.clock);
+            if (data.is_finished) {
+                stopClock();
+                showGameOver(data);
+                return;
+            }
+
+            // The server paces polls by load, whose turn it is and the time left
+            syncTimer = setTimeout(syncGame, data.next_poll_ms || 2000);
+        })
+        .catch(error => {
+            console.error('Error syncing game:', error);
+            if (generation !== syncGeneration) return;
+            syncTimer = setTimeout(syncGame, 5000);
+        });
+    }
+
+    // Initialize the game when the page loads
+    initializeBoard();
+    syncGame();
+
+    // Clean up timers when leaving page
+    window.addEventListener('beforeunload', function() {
+        clearTimeout(syncTimer);
+        stopClock();
+    });
+});
@@ -0,0 +1,39 @@
+document.addEventListener('DOMContentLoaded', function() {
+    // Start the queue timer
+    let queueTime = 0;
+    const timerElement = document.getElementById('queue-timer');
+
+    setInterval(() => {
+        queueTime++;
+        timerElement.textContent = queueTime;
+    }, 1000);
+
+    // Poll for game status, as often as the server suggests
+    function checkStatus() {
+        fetch('/api/check-status', {
+            method: 'GET',
+            headers: {
+                'Content-Type': 'application/json'
+            }
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.status === 'game_started') {
+                // A match has been found - redirect to game
+                window.location.href = `/game/${data.game_id}`;
+                return;
+            }
+            if (data.status === 'not_found') {
+                // Our queue entry expired (e.g. the tab was asleep) or was removed
+                window.location.href = '/';
+                return;
+            }
+            setTimeout(checkStatus, data.next_poll_ms || 2000);
+        })
+        .catch(error => {
+            console.error('Error checking status:', error);
+            setTimeout(checkStatus, 5000);
+        });
+    }
+    checkStatus();
+});